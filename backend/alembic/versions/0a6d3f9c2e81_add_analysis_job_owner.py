@@ -0,0 +1,30 @@
+"""add analysis job owner
+
+Revision ID: 0a6d3f9c2e81
+Revises: f5c2d8a4b713
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0a6d3f9c2e81'
+down_revision: Union[str, None] = 'f5c2d8a4b713'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('analysis_jobs', sa.Column('user_id', sa.Integer(), nullable=True))
+    op.add_column('analysis_jobs', sa.Column('job_size', sa.Integer(), nullable=True))
+    op.create_foreign_key('analysis_jobs_user_id_fkey', 'analysis_jobs', 'users', ['user_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    op.drop_constraint('analysis_jobs_user_id_fkey', 'analysis_jobs', type_='foreignkey')
+    op.drop_column('analysis_jobs', 'job_size')
+    op.drop_column('analysis_jobs', 'user_id')
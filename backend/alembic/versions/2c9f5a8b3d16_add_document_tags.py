@@ -0,0 +1,43 @@
+"""add document tags
+
+Revision ID: 2c9f5a8b3d16
+Revises: 1b8e4f7a2c95
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2c9f5a8b3d16'
+down_revision: Union[str, None] = '1b8e4f7a2c95'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('document_tags',
+    sa.Column('document_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('value', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('document_id', 'key', 'value')
+    )
+    op.create_index('ix_document_tags_key_value_document_id', 'document_tags', ['key', 'value', 'document_id'], unique=False)
+
+    # Backfill from the JSON column, skipping anything that isn't a list of {key, value} objects
+    op.execute("""
+        INSERT INTO document_tags (document_id, key, value)
+        SELECT DISTINCT d.id, tag->>'key', tag->>'value'
+        FROM documents d,
+             json_array_elements(CASE WHEN json_typeof(d.tags) = 'array' THEN d.tags ELSE '[]'::json END) AS tag
+        WHERE json_typeof(tag) = 'object' AND tag->>'key' <> '' AND tag->>'value' IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_document_tags_key_value_document_id', table_name='document_tags')
+    op.drop_table('document_tags')
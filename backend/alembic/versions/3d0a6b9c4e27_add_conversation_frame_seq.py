@@ -0,0 +1,33 @@
+"""add conversation frame seq
+
+Revision ID: 3d0a6b9c4e27
+Revises: 2c9f5a8b3d16
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d0a6b9c4e27'
+down_revision: Union[str, None] = '2c9f5a8b3d16'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('conversations', sa.Column('frame_seq', sa.Integer(), server_default='0', nullable=False))
+    # Continue numbering from the frames already journaled
+    op.execute("""
+        UPDATE conversations c
+        SET frame_seq = w.max_seq
+        FROM (SELECT conversation_id, max(seq) AS max_seq FROM websocket_messages GROUP BY conversation_id) w
+        WHERE w.conversation_id = c.id AND w.max_seq IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('conversations', 'frame_seq')
@@ -0,0 +1,37 @@
+"""add corpus stats
+
+Revision ID: 4e1b7c0d5f38
+Revises: 3d0a6b9c4e27
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e1b7c0d5f38'
+down_revision: Union[str, None] = '3d0a6b9c4e27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'corpus_stats',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('chunk_count', sa.BigInteger(), server_default='0', nullable=False),
+        sa.Column('total_terms', sa.BigInteger(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # The one stats row, seeded from the chunks already indexed
+    op.execute("""
+        INSERT INTO corpus_stats (id, chunk_count, total_terms)
+        SELECT 1, count(*), coalesce(sum(term_count), 0) FROM document_chunks
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('corpus_stats')
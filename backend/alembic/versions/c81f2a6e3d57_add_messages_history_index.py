@@ -0,0 +1,25 @@
+"""add messages history index
+
+Revision ID: c81f2a6e3d57
+Revises: 5b7e2d4c9a10
+Create Date: 2026-10-17 11:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81f2a6e3d57'
+down_revision: Union[str, None] = '5b7e2d4c9a10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_messages_conversation_id_created_at_id', 'messages', ['conversation_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_conversation_id_created_at_id', table_name='messages')
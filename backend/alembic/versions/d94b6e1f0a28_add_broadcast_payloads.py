@@ -0,0 +1,37 @@
+"""add broadcast payloads
+
+Revision ID: d94b6e1f0a28
+Revises: c81f2a6e3d57
+Create Date: 2026-10-17 12:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd94b6e1f0a28'
+down_revision: Union[str, None] = 'c81f2a6e3d57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('broadcast_payloads',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=True),
+    sa.Column('content', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['conversation_id'], ['conversations.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_broadcast_payloads_id'), 'broadcast_payloads', ['id'], unique=False)
+    op.create_index(op.f('ix_broadcast_payloads_created_at'), 'broadcast_payloads', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_broadcast_payloads_created_at'), table_name='broadcast_payloads')
+    op.drop_index(op.f('ix_broadcast_payloads_id'), table_name='broadcast_payloads')
+    op.drop_table('broadcast_payloads')
@@ -0,0 +1,28 @@
+"""add websocket message seq
+
+Revision ID: e3a7c5d91b62
+Revises: d94b6e1f0a28
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3a7c5d91b62'
+down_revision: Union[str, None] = 'd94b6e1f0a28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('websocket_messages', sa.Column('seq', sa.Integer(), nullable=True))
+    op.create_index('ix_websocket_messages_conversation_id_seq', 'websocket_messages', ['conversation_id', 'seq'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_websocket_messages_conversation_id_seq', table_name='websocket_messages')
+    op.drop_column('websocket_messages', 'seq')
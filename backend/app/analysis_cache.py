@@ -0,0 +1,247 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from .database import AsyncSessionLocal
+from .metrics import metrics
+from .models import AnalysisCacheEntry
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CACHE_TTL_HOURS = float(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "168"))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "50000"))
+ANALYSIS_CACHE_LRU_SIZE = int(os.getenv("ANALYSIS_CACHE_LRU_SIZE", "1024"))
+# Eviction runs every N writes rather than on every one
+ANALYSIS_CACHE_EVICT_EVERY = int(os.getenv("ANALYSIS_CACHE_EVICT_EVERY", "100"))
+# In-process hits are written back to last_accessed_at in batches, once this many are waiting or this long has passed
+ANALYSIS_CACHE_TOUCH_BATCH = int(os.getenv("ANALYSIS_CACHE_TOUCH_BATCH", "100"))
+ANALYSIS_CACHE_TOUCH_SECONDS = float(os.getenv("ANALYSIS_CACHE_TOUCH_SECONDS", "60"))
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def analysis_cache_key(content: str, user_question: str, model: str, prompt_version: str) -> str:
+    content_hash = hashlib.sha256((content or "").encode()).hexdigest()
+    parts = [content_hash, normalize_question(user_question), model, prompt_version]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+class AnalysisCache:
+    """Extraction results keyed by document content, question, model and prompt version.
+
+    An in-process LRU sits in front of the `analysis_cache` table. Entries
+    expire after `ttl`, and the table is trimmed to `max_entries` by least
+    recent access. Hits served from the LRU are written back to the table in
+    batches so eviction doesn't mistake the hottest entries for idle ones.
+    """
+
+    def __init__(self, ttl: datetime.timedelta, max_entries: int, lru_size: int, evict_every: int, touch_batch: int, touch_interval: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lru_size = lru_size
+        self.evict_every = evict_every
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self._lru: OrderedDict[str, Dict] = OrderedDict()
+        self._writes = 0
+        self._touched: Set[str] = set()
+        self._last_touch_flush = time.monotonic()
+        self._touch_task: Optional[asyncio.Task] = None
+
+        metrics.gauge("analysis_cache.lru_size", lambda: len(self._lru))
+
+    async def get(self, key: str) -> Optional[Dict]:
+        now = datetime.datetime.utcnow()
+
+        entry = self._lru.get(key)
+        if entry is not None:
+            if now - entry["created_at"] < self.ttl:
+                self._lru.move_to_end(key)
+                metrics.inc("analysis_cache.lru_hits")
+                self._touch(key)
+                return entry
+            self._lru.pop(key, None)
+
+        try:
+            async with AsyncSessionLocal() as db:
+                row = (await db.execute(
+                    select(AnalysisCacheEntry).where(
+                        AnalysisCacheEntry.key == key,
+                        AnalysisCacheEntry.created_at > now - self.ttl,
+                    )
+                )).scalars().first()
+                if row is None:
+                    metrics.inc("analysis_cache.misses")
+                    return None
+
+                await db.execute(
+                    update(AnalysisCacheEntry)
+                    .where(AnalysisCacheEntry.key == key)
+                    .values(last_accessed_at=now)
+                )
+                await db.commit()
+        except SQLAlchemyError as e:
+            # A broken cache should never fail the analysis itself
+            metrics.inc("analysis_cache.errors")
+            logger.error(f"Analysis cache lookup failed: {str(e)}")
+            return None
+
+        metrics.inc("analysis_cache.db_hits")
+        entry = {"response": row.response, "citations": row.citations, "created_at": row.created_at}
+        self._remember(key, entry)
+        return entry
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Dict]:
+        """Looks up several keys with one query, returning only the hits."""
+        now = datetime.datetime.utcnow()
+        found, missing = {}, []
+        for key in dict.fromkeys(keys):
+            entry = self._lru.get(key)
+            if entry is not None and now - entry["created_at"] < self.ttl:
+                self._lru.move_to_end(key)
+                metrics.inc("analysis_cache.lru_hits")
+                self._touch(key)
+                found[key] = entry
+            else:
+                self._lru.pop(key, None)
+                missing.append(key)
+        if not missing:
+            return found
+
+        try:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(
+                    select(AnalysisCacheEntry).where(
+                        AnalysisCacheEntry.key.in_(missing),
+                        AnalysisCacheEntry.created_at > now - self.ttl,
+                    )
+                )).scalars().all()
+                if rows:
+                    await db.execute(
+                        update(AnalysisCacheEntry)
+                        .where(AnalysisCacheEntry.key.in_([row.key for row in rows]))
+                        .values(last_accessed_at=now)
+                    )
+                    await db.commit()
+        except SQLAlchemyError as e:
+            metrics.inc("analysis_cache.errors")
+            logger.error(f"Analysis cache lookup failed: {str(e)}")
+            return found
+
+        metrics.inc("analysis_cache.db_hits", len(rows))
+        metrics.inc("analysis_cache.misses", len(missing) - len(rows))
+        for row in rows:
+            entry = {"response": row.response, "citations": row.citations, "created_at": row.created_at}
+            self._remember(row.key, entry)
+            found[row.key] = entry
+        return found
+
+    async def put(self, key: str, model: str, prompt_version: str, response: str, citations: List[Dict]):
+        now = datetime.datetime.utcnow()
+        values = {
+            "key": key,
+            "model": model,
+            "prompt_version": prompt_version,
+            "response": response,
+            "citations": citations,
+            "created_at": now,
+            "last_accessed_at": now,
+        }
+        statement = insert(AnalysisCacheEntry).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[AnalysisCacheEntry.key],
+            set_={column: statement.excluded[column] for column in values if column != "key"},
+        )
+
+        self._remember(key, {"response": response, "citations": citations, "created_at": now})
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(statement)
+                await db.commit()
+
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                await self.evict()
+        except SQLAlchemyError as e:
+            metrics.inc("analysis_cache.errors")
+            logger.error(f"Analysis cache write failed: {str(e)}")
+
+    async def flush_touches(self):
+        if not self._touched:
+            return
+        keys, self._touched = list(self._touched), set()
+        self._last_touch_flush = time.monotonic()
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(AnalysisCacheEntry)
+                    .where(AnalysisCacheEntry.key.in_(keys))
+                    .values(last_accessed_at=datetime.datetime.utcnow())
+                )
+                await db.commit()
+        except SQLAlchemyError as e:
+            metrics.inc("analysis_cache.errors")
+            logger.error(f"Analysis cache access update failed: {str(e)}")
+            return
+        metrics.inc("analysis_cache.touches", len(keys))
+
+    async def evict(self):
+        # Eviction goes by last_accessed_at, so it must see the hits served from memory
+        await self.flush_touches()
+        now = datetime.datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            expired = await db.execute(
+                delete(AnalysisCacheEntry).where(AnalysisCacheEntry.created_at <= now - self.ttl)
+            )
+
+            count = (await db.execute(select(func.count()).select_from(AnalysisCacheEntry))).scalar_one()
+            overflow = count - self.max_entries
+            evicted = 0
+            if overflow > 0:
+                oldest = (
+                    select(AnalysisCacheEntry.key)
+                    .order_by(AnalysisCacheEntry.last_accessed_at)
+                    .limit(overflow)
+                )
+                evicted = (await db.execute(
+                    delete(AnalysisCacheEntry).where(AnalysisCacheEntry.key.in_(oldest))
+                )).rowcount
+            await db.commit()
+
+        metrics.inc("analysis_cache.expired", expired.rowcount)
+        metrics.inc("analysis_cache.evicted", evicted)
+        logger.info(f"Analysis cache eviction: {expired.rowcount} expired, {evicted} over capacity")
+
+    def _touch(self, key: str):
+        self._touched.add(key)
+        due = len(self._touched) >= self.touch_batch or time.monotonic() - self._last_touch_flush >= self.touch_interval
+        if due and (self._touch_task is None or self._touch_task.done()):
+            self._touch_task = asyncio.create_task(self.flush_touches())
+
+    def _remember(self, key: str, entry: Dict):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+
+analysis_cache = AnalysisCache(
+    datetime.timedelta(hours=ANALYSIS_CACHE_TTL_HOURS),
+    ANALYSIS_CACHE_MAX_ENTRIES,
+    ANALYSIS_CACHE_LRU_SIZE,
+    ANALYSIS_CACHE_EVICT_EVERY,
+    ANALYSIS_CACHE_TOUCH_BATCH,
+    ANALYSIS_CACHE_TOUCH_SECONDS,
+)
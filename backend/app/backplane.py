@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import uuid
+from typing import Callable, Dict, List, Optional, Set
+
+import asyncpg
+from sqlalchemy import delete, func, insert, select
+
+from .database import SQLALCHEMY_DATABASE_URL, AsyncSessionLocal
+from .metrics import metrics
+from .models import BroadcastPayload
+
+logger = logging.getLogger(__name__)
+
+# postgres fans frames out to every worker, memory only reaches this process
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "postgres")
+BACKPLANE_MAX_QUEUE = int(os.getenv("BACKPLANE_MAX_QUEUE", "10000"))
+# NOTIFY payloads are capped at 8000 bytes, larger frames are stored and sent by id
+BACKPLANE_INLINE_BYTES = int(os.getenv("BACKPLANE_INLINE_BYTES", "7000"))
+BACKPLANE_PAYLOAD_TTL_SECONDS = int(os.getenv("BACKPLANE_PAYLOAD_TTL_SECONDS", "300"))
+BACKPLANE_RECONNECT_SECONDS = float(os.getenv("BACKPLANE_RECONNECT_SECONDS", "2"))
+
+Deliver = Callable[[int, str, bool, Optional[int]], None]
+# Called with a conversation id, or None when every cached history may be stale
+InvalidateHistory = Callable[[Optional[int]], None]
+# Called with the envelope of any other control event, holding its origin, conversation_id and event
+Control = Callable[[Dict], None]
+
+# Every worker listens here, whether or not it has sockets for the conversation
+CONTROL_CHANNEL = "chat_control"
+
+
+def conversation_channel(conversation_id: int) -> str:
+    return f"ws_conversation_{conversation_id}"
+
+
+class InProcessBackplane:
+    """Backplane for a single worker: local delivery already reaches everyone."""
+
+    origin = "local"
+
+    async def start(self, deliver: Deliver, invalidate_history: InvalidateHistory, control: Control):
+        pass
+
+    def publish(self, conversation_id: int, message: str, delta: bool = False, seq: Optional[int] = None):
+        pass
+
+    def publish_control(self, conversation_id: int, event: str, **fields):
+        pass
+
+    def publish_history_change(self, conversation_id: int):
+        pass
+
+    def subscribe(self, conversation_id: int):
+        pass
+
+    def unsubscribe(self, conversation_id: int):
+        pass
+
+    async def close(self):
+        pass
+
+
+class PostgresBackplane:
+    """Fans websocket frames out to other workers through LISTEN/NOTIFY.
+
+    Each worker LISTENs on a channel per conversation it has sockets for.
+    Frames are published from a background task, so the producer never waits
+    on the database. Frames too large for a NOTIFY payload are written to
+    `broadcast_payloads` in the same transaction and sent by id. A worker
+    ignores its own notifications since it already delivered those locally.
+    Control events, such as writes to a conversation's messages that make
+    other workers' cached history stale, go out on a channel every worker
+    listens to.
+    """
+
+    def __init__(self, dsn: str, max_queue: int, inline_bytes: int, payload_ttl: datetime.timedelta):
+        self.dsn = dsn
+        self.inline_bytes = inline_bytes
+        self.payload_ttl = payload_ttl
+        self.origin = uuid.uuid4().hex
+        self._deliver: Optional[Deliver] = None
+        self._invalidate_history: Optional[InvalidateHistory] = None
+        self._control: Optional[Control] = None
+        self._outgoing: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._incoming: asyncio.Queue = asyncio.Queue()
+        self._channels: Set[str] = set()
+        self._connection: Optional[asyncpg.Connection] = None
+        self._connection_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._published = 0
+
+        metrics.gauge("backplane.outgoing_queue", lambda: self._outgoing.qsize())
+        metrics.gauge("backplane.channels", lambda: len(self._channels))
+
+    async def start(self, deliver: Deliver, invalidate_history: InvalidateHistory, control: Control):
+        self._deliver = deliver
+        self._invalidate_history = invalidate_history
+        self._control = control
+        self._tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._publish_loop()),
+            asyncio.create_task(self._receive_loop()),
+        ]
+
+    def publish(self, conversation_id: int, message: str, delta: bool = False, seq: Optional[int] = None):
+        try:
+            self._outgoing.put_nowait((conversation_id, message, delta, seq, None))
+        except asyncio.QueueFull:
+            metrics.inc("backplane.dropped")
+            logger.warning(f"Backplane queue full, frame for conversation {conversation_id} not sent to other workers")
+
+    def publish_control(self, conversation_id: int, event: str, **fields):
+        # Queued with the frames so events stay in order with them
+        try:
+            self._outgoing.put_nowait((conversation_id, None, False, None, {"event": event, **fields}))
+        except asyncio.QueueFull:
+            metrics.inc("backplane.dropped")
+            logger.warning(f"Backplane queue full, {event} for conversation {conversation_id} not sent to other workers")
+
+    def publish_history_change(self, conversation_id: int):
+        self.publish_control(conversation_id, "history_changed")
+
+    def subscribe(self, conversation_id: int):
+        channel = conversation_channel(conversation_id)
+        if channel not in self._channels:
+            self._channels.add(channel)
+            asyncio.create_task(self._set_listening(channel, True))
+
+    def unsubscribe(self, conversation_id: int):
+        channel = conversation_channel(conversation_id)
+        if channel in self._channels:
+            self._channels.discard(channel)
+            asyncio.create_task(self._set_listening(channel, False))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._connection is not None and not self._connection.is_closed():
+            await self._connection.close()
+
+    async def _set_listening(self, channel: str, listening: bool):
+        # The lock keeps LISTEN/UNLISTEN for a channel in the order they were requested
+        async with self._connection_lock:
+            if self._connection is None or self._connection.is_closed():
+                # _listen subscribes to everything in _channels when it reconnects
+                return
+            try:
+                if listening and channel in self._channels:
+                    await self._connection.add_listener(channel, self._on_notification)
+                elif not listening and channel not in self._channels:
+                    await self._connection.remove_listener(channel, self._on_notification)
+            except (asyncpg.PostgresError, OSError) as e:
+                logger.error(f"Failed to update backplane subscription for {channel}: {str(e)}")
+
+    async def _listen(self):
+        while True:
+            terminated = asyncio.Event()
+            try:
+                async with self._connection_lock:
+                    self._connection = await asyncpg.connect(self.dsn)
+                    self._connection.add_termination_listener(lambda connection: terminated.set())
+                    await self._connection.add_listener(CONTROL_CHANNEL, self._on_notification)
+                    for channel in list(self._channels):
+                        await self._connection.add_listener(channel, self._on_notification)
+                # Changes announced while we weren't listening were missed
+                self._invalidate_history(None)
+                logger.info(f"Backplane listening on {len(self._channels)} channels")
+                await terminated.wait()
+                logger.warning("Backplane listener connection lost, reconnecting")
+            except (asyncpg.PostgresError, OSError) as e:
+                logger.error(f"Backplane listener failed: {str(e)}")
+            metrics.inc("backplane.reconnects")
+            await asyncio.sleep(BACKPLANE_RECONNECT_SECONDS)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self._incoming.put_nowait(payload)
+
+    async def _receive_loop(self):
+        # Notifications are handled one at a time so frames keep their order
+        while True:
+            payload = await self._incoming.get()
+            try:
+                envelope = json.loads(payload)
+                if envelope["origin"] == self.origin:
+                    continue
+                if envelope.get("event") == "history_changed":
+                    metrics.inc("backplane.history_invalidations")
+                    self._invalidate_history(envelope["conversation_id"])
+                    continue
+                if envelope.get("event"):
+                    metrics.inc("backplane.control_events")
+                    self._control(envelope)
+                    continue
+                message = envelope.get("message")
+                if message is None:
+                    async with AsyncSessionLocal() as db:
+                        message = (await db.execute(
+                            select(BroadcastPayload.content).where(BroadcastPayload.id == envelope["ref"])
+                        )).scalar_one_or_none()
+                    if message is None:
+                        metrics.inc("backplane.missing_payloads")
+                        continue
+                metrics.inc("backplane.received")
+                self._deliver(envelope["conversation_id"], message, envelope["delta"], envelope.get("seq"))
+            except Exception as e:
+                logger.error(f"Failed to deliver backplane notification: {str(e)}")
+
+    async def _publish_loop(self):
+        while True:
+            batch = [await self._outgoing.get()]
+            while not self._outgoing.empty():
+                batch.append(self._outgoing.get_nowait())
+            try:
+                await self._publish_batch(batch)
+            except Exception as e:
+                metrics.inc("backplane.publish_errors", len(batch))
+                logger.error(f"Failed to publish {len(batch)} frames to the backplane: {str(e)}")
+
+    async def _publish_batch(self, batch):
+        async with AsyncSessionLocal() as db:
+            for conversation_id, message, delta, seq, control in batch:
+                if control is not None:
+                    envelope = json.dumps({"origin": self.origin, "conversation_id": conversation_id, **control})
+                    await db.execute(select(func.pg_notify(CONTROL_CHANNEL, envelope)))
+                    continue
+                envelope = {"origin": self.origin, "conversation_id": conversation_id, "delta": delta, "seq": seq, "message": message}
+                payload = json.dumps(envelope)
+                if len(payload.encode()) > self.inline_bytes:
+                    envelope["message"] = None
+                    envelope["ref"] = (await db.execute(
+                        insert(BroadcastPayload).values(conversation_id=conversation_id, content=message).returning(BroadcastPayload.id)
+                    )).scalar_one()
+                    payload = json.dumps(envelope)
+                    metrics.inc("backplane.by_reference")
+                # Notifications are only sent on commit, after the payload rows are visible
+                await db.execute(select(func.pg_notify(conversation_channel(conversation_id), payload)))
+            await db.commit()
+
+            self._published += len(batch)
+            metrics.inc("backplane.published", len(batch))
+            if self._published >= 1000:
+                self._published = 0
+                await db.execute(delete(BroadcastPayload).where(
+                    BroadcastPayload.created_at < datetime.datetime.utcnow() - self.payload_ttl
+                ))
+                await db.commit()
+
+
+if BROADCAST_BACKEND == "postgres":
+    backplane = PostgresBackplane(
+        SQLALCHEMY_DATABASE_URL,
+        BACKPLANE_MAX_QUEUE,
+        BACKPLANE_INLINE_BYTES,
+        datetime.timedelta(seconds=BACKPLANE_PAYLOAD_TTL_SECONDS),
+    )
+else:
+    backplane = InProcessBackplane()
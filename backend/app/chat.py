@@ -3,9 +3,13 @@ import hashlib
 import json
 import logging
 import os
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from functools import partial
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set
 
 import jwt
 import openai
@@ -22,12 +26,20 @@ from fastapi import (
     status,
 )
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from lxml import html
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-
-from .database import get_db
+from sqlalchemy import delete, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .analysis_cache import analysis_cache, analysis_cache_key, normalize_question
+from .backplane import backplane
+from .citation_parser import CITATION_FIELDS, IncrementalCitationParser, format_citation_fields, parse_citations
+from .compaction import compact_history
+from .database import AsyncSessionLocal, get_async_db
+from .jobs import ANALYSIS_EXECUTION, run_analysis_job
+from .journal import websocket_journal
+from .metrics import metrics
 from .models import (
     Conversation,
     Document,
@@ -35,6 +47,19 @@ from .models import (
     User,
     WebSocketMessage,
 )
+from .retrieval import RETRIEVAL_MIN_TOKENS, RETRIEVAL_TOP_K, chunk_text, top_chunks
+from .scheduler import current_job_size, current_user_id, fair_scheduler
+from .streaming import (
+    WS_SEND_QUEUE_SIZE,
+    WS_SEND_TIMEOUT,
+    WS_SLOW_CONSUMER_POLICY,
+    ConnectionSender,
+    DeltaCoalescer,
+    assistant_message_frame,
+    with_seq,
+)
+from .tags import tag_filter, tag_pairs
+from .utils import estimate_tokens
 
 load_dotenv()
 
@@ -60,6 +85,31 @@ else:
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+ANALYSIS_MAX_RETRIES = int(os.getenv("ANALYSIS_MAX_RETRIES", "3"))
+# Documents larger than this are analyzed in parallel windows and merged
+ANALYSIS_CONTEXT_TOKENS = int(os.getenv("ANALYSIS_CONTEXT_TOKENS", "100000"))
+ANALYSIS_WINDOW_TOKENS = int(os.getenv("ANALYSIS_WINDOW_TOKENS", "60000"))
+ANALYSIS_WINDOW_OVERLAP_TOKENS = int(os.getenv("ANALYSIS_WINDOW_OVERLAP_TOKENS", "500"))
+CHAT_HISTORY_CACHE_BYTES = int(os.getenv("CHAT_HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+# Clients further behind than this get the conversation history instead of a replay
+REPLAY_MAX_FRAMES = int(os.getenv("REPLAY_MAX_FRAMES", "5000"))
+SEND_LOCK_CACHE_SIZE = 10000
+# Frame seqs are reserved in Postgres this many at a time and handed out from memory
+FRAME_SEQ_BLOCK = int(os.getenv("FRAME_SEQ_BLOCK", "64"))
+# How long a turn keeps running with nobody connected, so a dropped client can resume with last_seq
+DISCONNECT_CANCEL_GRACE_SECONDS = float(os.getenv("DISCONNECT_CANCEL_GRACE_SECONDS", "30"))
+# How long a replay waits for the worker running the turn to flush its journal
+REPLAY_FLUSH_TIMEOUT_SECONDS = float(os.getenv("REPLAY_FLUSH_TIMEOUT_SECONDS", "2"))
+# Bump whenever the extraction prompt changes so cached results are not reused
+EXTRACTION_PROMPT_VERSION = "1"
+# Documents up to PACK_DOCUMENT_TOKENS are packed together into one extraction call
+PACK_DOCUMENT_TOKENS = int(os.getenv("PACK_DOCUMENT_TOKENS", "2000"))
+PACK_BATCH_TOKENS = int(os.getenv("PACK_BATCH_TOKENS", "16000"))
+PACK_MAX_DOCUMENTS = int(os.getenv("PACK_MAX_DOCUMENTS", "20"))
+# Start extraction from the raw message while Claude is still deciding to call analyze_documents
+SPECULATIVE_ANALYSIS = os.getenv("SPECULATIVE_ANALYSIS", "false").lower() == "true"
+
 # Add these constants for JWT
 SECRET_KEY = "your-secret-key"  # Change this to a secure random string
 ALGORITHM = "HS256"
@@ -68,71 +118,259 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 1 week
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+class ConversationNotFound(Exception):
+    pass
+
 class WebSocketManager:
     def __init__(self):
-        self.active_connections: Dict[str, Dict[str, WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, conversation_id: str, user_id: str, db: Session):
+        self.active_connections: Dict[str, Dict[str, ConnectionSender]] = {}
+        # Held from allocating a frame's seq until it is delivered, so local order matches seq order
+        self._send_locks: OrderedDict[str, asyncio.Lock] = OrderedDict()
+        # The next seq and the last one reserved, per conversation
+        self._seq_blocks: Dict[str, List[int]] = {}
+        # What other workers announced on the backplane: who has sockets for a conversation, and who runs its turn
+        self.remote_connections: Dict[str, Set[str]] = {}
+        self.remote_turns: Dict[str, str] = {}
+        self._journal_flushes: Dict[str, asyncio.Future] = {}
+
+        metrics.gauge("ws_send.queued", lambda: sum(
+            len(sender) for connections in self.active_connections.values() for sender in connections.values()
+        ))
+
+    async def connect(self, websocket: WebSocket, conversation_id: str, user_id: str, db: AsyncSession, last_seq: Optional[int] = None):
         await websocket.accept()
         if conversation_id not in self.active_connections:
             self.active_connections[conversation_id] = {}
-        self.active_connections[conversation_id][user_id] = websocket
-        
-        # Fetch and send conversation history
-        await self.send_conversation_history(conversation_id, user_id, db)
-
-    def disconnect(self, conversation_id: str, user_id: str):
-        if conversation_id in self.active_connections:
-            self.active_connections[conversation_id].pop(user_id, None)
-            if not self.active_connections[conversation_id]:
-                self.active_connections.pop(conversation_id, None)
-
-    async def send_message(self, conversation_id: str, message: str, db: Session):
-        if conversation_id in self.active_connections:
-            for websocket in self.active_connections[conversation_id].values():
-                await websocket.send_text(message)
-            
-            # Store outgoing message
-            websocket_message = WebSocketMessage(
-                conversation_id=conversation_id,
-                message_type="system",
-                content=message
-            )
-            db.add(websocket_message)
-            db.commit()
-
-    async def send_conversation_history(self, conversation_id: str, user_id: str, db: Session):
-        messages = db.query(Message)\
-            .filter(Message.conversation_id == conversation_id)\
-            .order_by(Message.created_at)\
-            .all()
+            backplane.subscribe(conversation_id)
+            backplane.publish_control(conversation_id, "connected")
+
+        previous = self.active_connections[conversation_id].get(user_id)
+        if previous:
+            previous.close()
+
+        # A resuming client gets live frames only after the ones it missed
+        sender = ConnectionSender(
+            websocket, WS_SEND_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY, WS_SEND_TIMEOUT,
+            lambda: self.disconnect(conversation_id, user_id, sender),
+            paused=last_seq is not None,
+        )
+        self.active_connections[conversation_id][user_id] = sender
         
-        filtered = [
-            m for m in messages if 
-            m.role not in ['user', 'assistant'] or 
-            any(content.get('type') == 'text' for content in m.content)
-        ]
+        if last_seq is None:
+            # Fetch and send conversation history
+            await self.send_conversation_history(conversation_id, user_id, db)
+        else:
+            await self.replay(sender, conversation_id, db, last_seq)
+        return sender
+
+    async def replay(self, sender: ConnectionSender, conversation_id: str, db: AsyncSession, last_seq: int):
+        # Frames this worker sent recently may still be waiting in the journal, as may the turn's if another worker runs it
+        await websocket_journal.flush()
+        owner = self.remote_turns.get(conversation_id)
+        if owner:
+            await self.flush_remote_journal(conversation_id, owner)
+        result = await db.execute(
+            select(WebSocketMessage.content, WebSocketMessage.seq)
+            .where(WebSocketMessage.conversation_id == conversation_id, WebSocketMessage.seq > last_seq)
+            .order_by(WebSocketMessage.seq)
+            .limit(REPLAY_MAX_FRAMES + 1)
+        )
+        frames = result.all()
+
+        if len(frames) > REPLAY_MAX_FRAMES:
+            # Too far behind to catch up frame by frame, start over from the history
+            metrics.inc("ws_replay.fallbacks")
+            sender.resume([(await self.conversation_history_frame(conversation_id, db), None)])
+            return
+
+        metrics.inc("ws_replay.frames", len(frames))
+        sender.resume([(content, seq) for content, seq in frames])
+
+    async def flush_remote_journal(self, conversation_id: str, origin: str):
+        request = uuid.uuid4().hex
+        flushed = self._journal_flushes[request] = asyncio.get_running_loop().create_future()
+        backplane.publish_control(conversation_id, "flush_journal", target=origin, request=request)
+        try:
+            await asyncio.wait_for(flushed, REPLAY_FLUSH_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # Replay anyway, the journal flushes on its own shortly and the gap may be small
+            metrics.inc("ws_replay.flush_timeouts")
+            logger.warning(f"Timed out waiting for worker {origin} to flush its journal for conversation {conversation_id}")
+        finally:
+            self._journal_flushes.pop(request, None)
+
+    def journal_flushed(self, request: str):
+        flushed = self._journal_flushes.get(request)
+        if flushed and not flushed.done():
+            flushed.set_result(None)
+
+    def has_connections(self, conversation_id: str) -> bool:
+        return conversation_id in self.active_connections or bool(self.remote_connections.get(conversation_id))
+
+    def disconnect(self, conversation_id: str, user_id: str, sender: Optional[ConnectionSender] = None):
+        connections = self.active_connections.get(conversation_id)
+        if sender:
+            sender.close()
+        # The same user may have reconnected since, leave the newer connection alone
+        if connections is None or (sender and connections.get(user_id) is not sender):
+            return
+
+        current = connections.pop(user_id, None)
+        if current:
+            current.close()
+        if not connections:
+            self.active_connections.pop(conversation_id, None)
+            backplane.unsubscribe(conversation_id)
+            backplane.publish_control(conversation_id, "disconnected")
+
+    def deliver(self, conversation_id: str, payload: str, delta: bool = False, seq: Optional[int] = None):
+        block = self._seq_blocks.get(conversation_id)
+        if seq is not None and block and seq >= block[0]:
+            # Another worker is numbering past our block, reserve a fresh one so our frames sort after theirs
+            del self._seq_blocks[conversation_id]
+        for sender in list(self.active_connections.get(conversation_id, {}).values()):
+            sender.send(payload, delta, seq)
+
+    async def next_seq(self, conversation_id: str) -> int:
+        # Only called with the conversation's send lock held
+        block = self._seq_blocks.get(conversation_id)
+        if block is None or block[0] > block[1]:
+            block = self._seq_blocks[conversation_id] = await self.reserve_seqs(conversation_id, FRAME_SEQ_BLOCK)
+        seq = block[0]
+        block[0] += 1
+        return seq
+
+    async def reserve_seqs(self, conversation_id: str, count: int) -> List[int]:
+        # Reserved from one counter in Postgres so every worker numbers a conversation's frames uniquely
+        async with AsyncSessionLocal() as db:
+            last = (await db.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                # Numbering frames isn't activity, leave updated_at alone
+                .values(frame_seq=Conversation.frame_seq + count, updated_at=Conversation.updated_at)
+                .returning(Conversation.frame_seq)
+            )).scalar_one_or_none()
+            await db.commit()
+        if last is None:
+            raise ConversationNotFound(f"Conversation {conversation_id} no longer exists")
+        metrics.inc("ws_seq.reservations")
+        return [last - count + 1, last]
+
+    def send_lock(self, conversation_id: str) -> asyncio.Lock:
+        lock = self._send_locks.get(conversation_id)
+        if lock is None:
+            lock = self._send_locks[conversation_id] = asyncio.Lock()
+            for idle in [key for key, held in self._send_locks.items() if not held.locked()][:max(0, len(self._send_locks) - SEND_LOCK_CACHE_SIZE)]:
+                del self._send_locks[idle]
+                # The rest of its block is simply never used
+                self._seq_blocks.pop(idle, None)
+        self._send_locks.move_to_end(conversation_id)
+        return lock
+
+    async def send_message(self, conversation_id: str, message: str):
+        async with self.send_lock(conversation_id):
+            seq = await self.next_seq(conversation_id)
+            message = with_seq(message, seq)
+            self.deliver(conversation_id, message, seq=seq)
+            backplane.publish(conversation_id, message, seq=seq)
+
+        # Store outgoing message
+        await websocket_journal.record(conversation_id, "system", message, seq)
+
+    async def send_delta(self, conversation_id: str, text: str):
+        async with self.send_lock(conversation_id):
+            seq = await self.next_seq(conversation_id)
+            self.deliver(conversation_id, text, delta=True, seq=seq)
+            backplane.publish(conversation_id, text, delta=True, seq=seq)
+
+        await websocket_journal.record(conversation_id, "system", assistant_message_frame(text, seq), seq)
+
+    def send_to(self, conversation_id: str, user_id: str, message: str):
+        sender = self.active_connections.get(conversation_id, {}).get(user_id)
+        if sender:
+            sender.send(message)
+
+    async def send_conversation_history(self, conversation_id: str, user_id: str, db: AsyncSession, cursor: Optional[str] = None):
+        self.send_to(conversation_id, user_id, await self.conversation_history_frame(conversation_id, db, cursor))
+
+    async def conversation_history_frame(self, conversation_id: str, db: AsyncSession, cursor: Optional[str] = None) -> str:
+        before = decode_history_cursor(cursor) if cursor else None
+        messages, has_more = await fetch_history_page(db, conversation_id, before, HISTORY_PAGE_SIZE)
 
         history_message = {
-            "type": "conversation_history",
-            "content": [m.to_dict() for m in filtered]
+            # The first page replaces the client's history, later pages are prepended to it
+            "type": "conversation_history_page" if cursor else "conversation_history",
+            "content": [m.to_dict() for m in messages],
+            "has_more": has_more,
+            "cursor": encode_history_cursor(messages[0]) if messages and has_more else None,
         }
 
-        if conversation_id in self.active_connections and user_id in self.active_connections[conversation_id]:
-            await self.active_connections[conversation_id][user_id].send_text(json.dumps(history_message))
+        return json.dumps(history_message)
 
 websocket_manager = WebSocketManager()
 
-class ChatManager:
-    def __init__(self):
-        pass
 
-    def get_history(self, db: Session, conversation_id: str) -> List[Dict]:
-        messages = db.query(Message).filter(
+def encode_history_cursor(message: Message) -> str:
+    return f"{message.created_at.isoformat()}|{message.id}"
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, int]:
+    created_at, message_id = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+async def fetch_history_page(db: AsyncSession, conversation_id: str, before: Optional[tuple[datetime, int]], limit: int) -> tuple[List[Message], bool]:
+    """Return up to `limit` displayable messages older than `before`, oldest first."""
+    # Tool-only user/assistant messages are never shown, skip them in the database
+    has_text = Message.content.cast(JSONB).contains([{"type": "text"}])
+    query = (
+        select(Message)
+        .where(
             Message.conversation_id == conversation_id,
-            Message.role.in_(['user', 'assistant'])
-        ).order_by(Message.created_at).all()
-        return [self.format_message_for_claude(message.to_dict()) for message in messages]
+            or_(Message.role.not_in(['user', 'assistant']), has_text),
+        )
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        query = query.where(tuple_(Message.created_at, Message.id) < tuple_(*before))
+
+    messages = (await db.execute(query)).scalars().all()
+    return list(reversed(messages[:limit])), len(messages) > limit
+
+
+class ChatManager:
+    def __init__(self, max_cache_bytes: int):
+        # Append-only Claude-formatted history per conversation, evicted LRU by serialized size
+        self.max_cache_bytes = max_cache_bytes
+        self._history: OrderedDict[str, List[Dict]] = OrderedDict()
+        self._history_bytes: Dict[str, int] = {}
+        self._cache_bytes = 0
+
+        metrics.gauge("chat_history_cache.bytes", lambda: self._cache_bytes)
+        metrics.gauge("chat_history_cache.conversations", lambda: len(self._history))
+
+    async def get_history(self, db: AsyncSession, conversation_id: str) -> List[Dict]:
+        if conversation_id in self._history:
+            metrics.inc("chat_history_cache.hits")
+            self._history.move_to_end(conversation_id)
+            return list(self._history[conversation_id])
+
+        metrics.inc("chat_history_cache.misses")
+        result = await db.execute(
+            select(Message).where(
+                Message.conversation_id == conversation_id,
+                Message.role.in_(['user', 'assistant'])
+            ).order_by(Message.created_at)
+        )
+        messages = result.scalars().all()
+        history = [self.format_message_for_claude(message.to_dict()) for message in messages]
+
+        self._history[conversation_id] = history
+        self._history_bytes[conversation_id] = sum(len(json.dumps(message)) for message in history)
+        self._cache_bytes += self._history_bytes[conversation_id]
+        self._evict()
+        return list(history)
 
     def format_message_for_claude(self, message: Dict) -> Dict:
         return {
@@ -140,26 +378,116 @@ class ChatManager:
             "content": message["content"]
         }
 
-    def add_message(self, db: Session, conversation_id: str, message: Dict):
+    async def add_message(self, db: AsyncSession, conversation_id: str, message: Dict):
         new_message = Message(
             conversation_id=conversation_id,
             role=message["role"],
             content=message["content"]
         )
         db.add(new_message)
-        db.commit()
-
-    def clear_history(self, db: Session, conversation_id: str):
-        db.query(Message).filter(Message.conversation_id == conversation_id).delete()
-        db.commit()
+        await db.commit()
+        if message["role"] in ['user', 'assistant']:
+            backplane.publish_history_change(conversation_id)
+
+        if conversation_id in self._history and message["role"] in ['user', 'assistant']:
+            formatted = self.format_message_for_claude(message)
+            size = len(json.dumps(formatted))
+            self._history[conversation_id].append(formatted)
+            self._history_bytes[conversation_id] += size
+            self._cache_bytes += size
+            self._evict()
+
+    async def clear_history(self, db: AsyncSession, conversation_id: str):
+        await db.execute(delete(Message).where(Message.conversation_id == conversation_id))
+        await db.commit()
+        backplane.publish_history_change(conversation_id)
+        self.invalidate(conversation_id)
+
+    def invalidate(self, conversation_id: Optional[str]):
+        # None drops every conversation, e.g. after missing changes from other workers
+        if conversation_id is None:
+            self._history.clear()
+            self._history_bytes.clear()
+            self._cache_bytes = 0
+        elif self._history.pop(conversation_id, None) is not None:
+            self._cache_bytes -= self._history_bytes.pop(conversation_id)
+
+    def _evict(self):
+        while self._cache_bytes > self.max_cache_bytes and self._history:
+            conversation_id, _ = self._history.popitem(last=False)
+            self._cache_bytes -= self._history_bytes.pop(conversation_id)
+            metrics.inc("chat_history_cache.evictions")
         
 
-chat_manager = ChatManager()
+chat_manager = ChatManager(CHAT_HISTORY_CACHE_BYTES)
+
+# The running turn of each conversation, so it can be stopped or cancelled on disconnect
+active_turns: Dict[str, asyncio.Task] = {}
+# Cancellations waiting out the reconnect grace period after the last socket closed
+pending_cancellations: Dict[str, asyncio.TimerHandle] = {}
+
+def schedule_turn_cancellation(conversation_id: str):
+    turn = active_turns.get(conversation_id)
+    if not turn or turn.done() or conversation_id in pending_cancellations:
+        return
+
+    def cancel_if_abandoned():
+        pending_cancellations.pop(conversation_id, None)
+        if not websocket_manager.has_connections(conversation_id) and active_turns.get(conversation_id) is turn:
+            metrics.inc("turns.cancelled_on_disconnect")
+            turn.cancel()
+
+    pending_cancellations[conversation_id] = asyncio.get_running_loop().call_later(DISCONNECT_CANCEL_GRACE_SECONDS, cancel_if_abandoned)
+
+def clear_turn_cancellation(conversation_id: str):
+    handle = pending_cancellations.pop(conversation_id, None)
+    if handle:
+        handle.cancel()
+
+def stop_turn(conversation_id: str):
+    clear_turn_cancellation(conversation_id)
+    turn = active_turns.get(conversation_id)
+    if turn and not turn.done():
+        turn.cancel()
+
+async def flush_journal_for(conversation_id: str, request: str):
+    await websocket_journal.flush()
+    backplane.publish_control(conversation_id, "journal_flushed", request=request)
+
+def handle_control(envelope: Dict):
+    """Applies a control event another worker announced on the backplane."""
+    conversation_id, origin, event = envelope["conversation_id"], envelope["origin"], envelope["event"]
+    targeted = envelope.get("target") == backplane.origin
+
+    if event == "connected":
+        websocket_manager.remote_connections.setdefault(conversation_id, set()).add(origin)
+        # The client came back through another worker
+        clear_turn_cancellation(conversation_id)
+    elif event == "disconnected":
+        origins = websocket_manager.remote_connections.get(conversation_id, set())
+        origins.discard(origin)
+        if not origins:
+            websocket_manager.remote_connections.pop(conversation_id, None)
+        if not websocket_manager.has_connections(conversation_id):
+            schedule_turn_cancellation(conversation_id)
+    elif event == "turn_started":
+        websocket_manager.remote_turns[conversation_id] = origin
+    elif event == "turn_ended":
+        if websocket_manager.remote_turns.get(conversation_id) == origin:
+            websocket_manager.remote_turns.pop(conversation_id, None)
+    elif event == "stop" and targeted:
+        stop_turn(conversation_id)
+    elif event == "flush_journal" and targeted:
+        asyncio.create_task(flush_journal_for(conversation_id, envelope["request"]))
+    elif event == "journal_flushed":
+        websocket_manager.journal_flushed(envelope["request"])
 
 class DocumentStatus(Enum):
     PENDING = "pending"
     IN_PROGRESS = "in_progress"
     COMPLETE = "complete"
+    # Finished, but the stream failed part way so later citations may be missing
+    PARTIAL = "partial"
     ERROR = "error"
 
 async def stream_response(client: AsyncAnthropicBedrock | AsyncAnthropic, messages: List[Dict], system_prompt: str, tools: List[Dict]) -> AsyncGenerator[str, None]:
@@ -208,20 +536,8 @@ async def stream_response(client: AsyncAnthropicBedrock | AsyncAnthropic, messag
                 if event.delta.stop_reason == "tool_use":
                     return  # Stop streaming to handle tool use
 
-async def analyze_single_document(document: Dict, user_question: str, conversation_id: str, db: Session) -> tuple[str, Dict]:
-    try:
-        # Send in_progress status
-        await websocket_manager.send_message(conversation_id, json.dumps({
-            "type": "document_analysis",
-            "status": DocumentStatus.IN_PROGRESS.value,
-            "document_id": document['document_id'],
-            "document_date": document['document_date'].strftime("%Y-%m-%d"),
-            "document_filename": document['document_filename'],
-        }), db)
-
-        logger.info(f"Analyzing document: {document}")
-
-        prompt = f"""
+def build_extraction_prompt(document: Dict, user_question: str) -> str:
+    return f"""
         You are a extraction agent in a multi-agent system.
         Your goal is to extract text from the document that is relevant to the user's question.
         The larger system will use your output as well as other subagent outputs to form a complete response.
@@ -285,16 +601,148 @@ async def analyze_single_document(document: Dict, user_question: str, conversati
         </instructions>
         """.strip()
 
-        response = await openai_client.chat.completions.create(
-            model=openai_model,
-            messages=[
-                {"role": "user", "content": prompt},
-            ],
-        )
-        
-        response_content = response.choices[0].message.content
+def build_batch_extraction_prompt(documents: List[Dict], user_question: str) -> str:
+    document_elements = "\n".join(
+        f"""
+        <document>
+        <document_id>{document['document_id']}</document_id>
+        <document_date>{document['document_date']}</document_date>
+        <document_content>{document['content']}</document_content>
+        <document_tags>{document['document_tags']}</document_tags>
+        </document>"""
+        for document in documents
+    )
+    return f"""
+        You are a extraction agent in a multi-agent system.
+        Your goal is to extract text from the documents that is relevant to the user's question.
+        The larger system will use your output as well as other subagent outputs to form a complete response.
+
+        <documents>{document_elements}
+        </documents>
 
-        result = f"""
+        <user_question>
+        {user_question}
+        </user_question>
+
+        <output>
+        <thinking>
+        [your thoughts here]
+        </thinking>
+        <citations>
+        <citation>
+        <document_id>
+        [document_id of the document the text is from]
+        </document_id>
+        <text>
+        [verbatim text from the document]
+        </text>
+        <explanation>
+        [explanation of why the citation is relevant to the user's question]
+        </explanation>
+        <relevance_score>
+        [relevance score between 1 and 10, 1 is not relevant, 10 is completely relevant]
+        </relevance_score>
+        <context>
+        [short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk]
+        </context>
+        </citation>
+        ...
+        </citations>
+        </output>
+
+        <instructions>
+        - The goal is to extract text verbatim from the documents that could help answer the user's question.
+        - Think about what you are going to do in a <thinking> tag first.
+        - Treat each document separately. Every citation must come from a single document, and its <document_id> tag must contain that document's id exactly.
+        - Pay attention to context. If the citation isn't from an authoritative source then mention it in the <explanation> tag. (For example, if the citation is from a analyst asking a question, then it's not authoritative.)
+        - Extract text verbatim from the document that is relevant to the user's question. The text should match the document exactly, including punctuation, capitalization, and spacing. Do not truncate sentences or phrases when extracting text.
+        - Include enough context in the <text> tag such that each citation is understandable on its own. Extract several sentences before and after the citation to provide context.
+        - Include a short explanation of why the citation is relevant to the user's question in the <explanation> tag.
+        - Include a short context in the <context> tag to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
+        - If no citations are found, return an empty <citation> element.
+        </instructions>
+        """.strip()
+
+async def run_extraction(prompt: str, on_citation: Optional[Callable[[Dict], Awaitable[None]]] = None) -> tuple[str, bool]:
+    """Returns the extraction output and whether the stream finished, rather than failing part way."""
+    for attempt in range(ANALYSIS_MAX_RETRIES + 1):
+        parts = []
+        try:
+            async with fair_scheduler.acquire(estimate_tokens(prompt)) as timer:
+                stream = await openai_client.chat.completions.create(
+                    model=openai_model,
+                    messages=[
+                        {"role": "user", "content": prompt},
+                    ],
+                    stream=True,
+                )
+                parser = IncrementalCitationParser()
+                # Closing the stream on cancellation aborts the request instead of draining it
+                async with stream:
+                    async for chunk in stream:
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        timer.first_token()
+                        parts.append(chunk.choices[0].delta.content)
+                        for fields in parser.feed(chunk.choices[0].delta.content):
+                            if on_citation:
+                                await on_citation(fields)
+            return "".join(parts), True
+        except asyncio.CancelledError:
+            metrics.inc("analysis.cancelled_calls")
+            metrics.inc("analysis.cancelled_prompt_tokens", estimate_tokens(prompt))
+            raise
+        except openai.RateLimitError:
+            if attempt == ANALYSIS_MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+        except openai.APIError as e:
+            if not parts:
+                raise
+            # Keep whatever was streamed before the failure, complete citations are still usable
+            metrics.inc("analysis.partial_extractions")
+            logger.warning(f"Extraction stream failed after {len(parts)} chunks, keeping partial output: {str(e)}")
+            return "".join(parts), False
+
+async def analyze_document_windows(document: Dict, user_question: str, send: Callable[[str], Awaitable[None]]) -> tuple[str, bool]:
+    windows = chunk_text(document['content'], ANALYSIS_WINDOW_TOKENS, ANALYSIS_WINDOW_OVERLAP_TOKENS)
+    total_windows = len(windows)
+    completed_windows = 0
+    logger.info(f"Splitting document {document['document_id']} into {total_windows} windows")
+
+    async def analyze_window(window_content: str) -> tuple[str, bool]:
+        nonlocal completed_windows
+        response_content, complete = await run_extraction(build_extraction_prompt({**document, 'content': window_content}, user_question))
+        completed_windows += 1
+        await send(json.dumps({
+            "type": "document_analysis",
+            "status": DocumentStatus.IN_PROGRESS.value,
+            "document_id": document['document_id'],
+            "document_date": document['document_date'].strftime("%Y-%m-%d"),
+            "document_filename": document['document_filename'],
+            "completed_windows": completed_windows,
+            "total_windows": total_windows,
+        }))
+        return response_content, complete
+
+    responses = await asyncio.gather(*[analyze_window(content) for _, content in windows])
+    return merge_window_responses([response for response, _ in responses]), all(complete for _, complete in responses)
+
+def merge_window_responses(responses: List[str]) -> str:
+    # Overlapping windows often extract the same passage, keep the longest copy
+    merged = []
+    for response in responses:
+        for fields in parse_citations(response):
+            text = " ".join(fields['text'].split())
+            if any(text in existing for existing, _ in merged):
+                continue
+            merged = [(existing, kept) for existing, kept in merged if existing not in text]
+            merged.append((text, fields))
+
+    return "<citations>\n" + "\n".join(format_citation_fields(fields) for _, fields in merged) + "\n</citations>"
+
+def format_document_result(document: Dict, response_content: str) -> str:
+    return f"""
 <response>
 <document_id>{document['document_id']}</document_id>
 <document_date>{document['document_date']}</document_date>
@@ -302,63 +750,279 @@ async def analyze_single_document(document: Dict, user_question: str, conversati
 </response>
 """.strip()
 
-        logger.info(f"Completed analysis for: {document['document_id']} ({document['document_date']})")
+async def analyze_single_document(document: Dict, user_question: str, conversation_id: str, send: Optional[Callable[[str], Awaitable[None]]] = None, cache_hits: Optional[Dict[str, Dict]] = None) -> tuple[str, list[dict]]:
+    # Job workers pass their own `send` to relay frames back to the web process
+    send = send or partial(websocket_manager.send_message, conversation_id)
+    try:
+        cache_key = analysis_cache_key(document['content'], user_question, openai_model, EXTRACTION_PROMPT_VERSION)
+        # Inline analysis already looked every document up in one batch, keys missing from it are misses
+        cached = cache_hits.get(cache_key) if cache_hits is not None else await analysis_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Cache hit for: {document['document_id']} ({document['document_date']})")
+
+            await send(json.dumps({
+                "type": "document_analysis",
+                "status": DocumentStatus.COMPLETE.value,
+                "document_id": document['document_id'],
+                "document_date": document['document_date'].strftime("%Y-%m-%d"),
+                "document_filename": document['document_filename'],
+                "cached": True,
+            }))
+
+            citations = [build_citation(fields, document) for fields in cached["citations"]]
+            return format_document_result(document, cached["response"]), citations
+
+        # Send in_progress status
+        await send(json.dumps({
+            "type": "document_analysis",
+            "status": DocumentStatus.IN_PROGRESS.value,
+            "document_id": document['document_id'],
+            "document_date": document['document_date'].strftime("%Y-%m-%d"),
+            "document_filename": document['document_filename'],
+        }))
+
+        logger.info(f"Analyzing document: {document}")
+
+        response_content, complete = None, True
+        speculative = speculative_extractions.get(cache_key)
+        if speculative is not None:
+            try:
+                # Shielded so this caller going away doesn't cancel work others may share
+                response_content = await asyncio.shield(speculative)
+            except asyncio.CancelledError:
+                if not speculative.cancelled():
+                    raise
+            if response_content is not None:
+                metrics.inc("speculation.reused")
+
+        if response_content is None:
+            if estimate_tokens(document['content'] or "") > ANALYSIS_CONTEXT_TOKENS:
+                response_content, complete = await analyze_document_windows(document, user_question, send)
+            else:
+                async def send_citation(fields: Dict):
+                    await send(json.dumps({
+                        "type": "partial_citations",
+                        "document_id": document['document_id'],
+                        "citations": [build_citation(fields, document)]
+                    }))
+
+                prompt = build_extraction_prompt(document, user_question)
+                response_content, complete = await run_extraction(prompt, on_citation=send_citation)
+
+        result = format_document_result(document, response_content)
+        citation_fields = parse_citation_fields(result)
+        if complete:
+            await analysis_cache.put(cache_key, openai_model, EXTRACTION_PROMPT_VERSION, response_content, citation_fields)
+            logger.info(f"Completed analysis for: {document['document_id']} ({document['document_date']})")
+        else:
+            # Truncated output must not be served from the cache as the full answer
+            logger.warning(f"Partial analysis for: {document['document_id']} ({document['document_date']})")
 
         # Send complete status
-        await websocket_manager.send_message(conversation_id, json.dumps({
+        await send(json.dumps({
             "type": "document_analysis",
-            "status": DocumentStatus.COMPLETE.value,
+            "status": (DocumentStatus.COMPLETE if complete else DocumentStatus.PARTIAL).value,
             "document_id": document['document_id'],
             "document_date": document['document_date'].strftime("%Y-%m-%d"),
             "document_filename": document['document_filename'],
-        }), db)
+        }))
 
-        return result, document
+        return result, [build_citation(fields, document) for fields in citation_fields]
 
     except Exception as e:
         # Send error status
-        await websocket_manager.send_message(conversation_id, json.dumps({
+        await send(json.dumps({
             "type": "document_analysis",
             "status": DocumentStatus.ERROR.value,
             "document_id": document['document_id'],
             "document_date": document['document_date'].strftime("%Y-%m-%d"),
             "document_filename": document['document_filename'],
             "error": str(e)
-        }), db)
+        }))
         raise
 
-def extract_citations_from_response(response: str, document: Dict) -> list[dict]:
-    citations = []
+def pack_documents(documents: List[Dict], batch_tokens: int, max_documents: int) -> List[List[Dict]]:
+    # First fit decreasing, largest documents first so the small ones fill the gaps
+    batches = []
+    for document in sorted(documents, key=lambda doc: estimate_tokens(doc['content'] or ""), reverse=True):
+        tokens = estimate_tokens(document['content'] or "")
+        for batch in batches:
+            if batch[0] + tokens <= batch_tokens and len(batch[1]) < max_documents:
+                batch[0] += tokens
+                batch[1].append(document)
+                break
+        else:
+            batches.append([tokens, [document]])
+    return [batch for _, batch in batches]
+
+async def analyze_document_batch(documents: List[Dict], user_question: str, conversation_id: str) -> List[tuple[Dict, list[dict]]]:
+    """Analyzes several small documents with one extraction call.
+
+    Citations are attributed by the `<document_id>` the model tags them with,
+    falling back to finding the quoted text in one of the documents. Results
+    are cached per document, exactly as if each had been analyzed alone.
+    """
+    send = partial(websocket_manager.send_message, conversation_id)
+    documents_by_id = {str(document['document_id']): document for document in documents}
+    normalized_contents = [(document, " ".join((document['content'] or "").split())) for document in documents]
+
+    async def send_status(document: Dict, status: DocumentStatus, **extra):
+        await send(json.dumps({
+            "type": "document_analysis",
+            "status": status.value,
+            "document_id": document['document_id'],
+            "document_date": document['document_date'].strftime("%Y-%m-%d"),
+            "document_filename": document['document_filename'],
+            **extra,
+        }))
+
+    def attribute(fields: Dict) -> Optional[Dict]:
+        document = documents_by_id.get(fields.get('document_id', '').strip())
+        if document is not None:
+            return document
+        text = " ".join(fields['text'].split())
+        return next((document for document, content in normalized_contents if text in content), None)
+
     try:
-        root = html.fromstring(response)
-        document_id = document['document_id']
-        document_date = document['document_date'].strftime("%Y-%m-%d")  
-        document_tags = document['document_tags']
-        document_filename = document['document_filename']
-        for citation in root.findall('.//citation'):
-            text = citation.find('text').text if citation.find('text') is not None else ''
-            explanation = citation.find('explanation').text if citation.find('explanation') is not None else ''
-            context = citation.find('context').text if citation.find('context') is not None else ''
-            relevance_score = citation.find('relevance_score').text if citation.find('relevance_score') is not None else ''
-            citation_dict = {
-                "id": hashlib.sha256(f"{document_id}-{text}".encode()).hexdigest()[:5],
-                "text": text,
-                "explanation": explanation,
-                "document_id": document_id,
-                "document_date": document_date,
-                "document_tags": document_tags,
-                "document_filename": document_filename,
-                "context": context,
-                "relevance_score": relevance_score
-            }
-            # Skip empty citations
-            if not text:
+        for document in documents:
+            await send_status(document, DocumentStatus.IN_PROGRESS)
+
+        async def send_citation(fields: Dict):
+            document = attribute(fields)
+            if document is not None:
+                await send(json.dumps({
+                    "type": "partial_citations",
+                    "document_id": document['document_id'],
+                    "citations": [build_citation(fields, document)]
+                }))
+
+        logger.info(f"Analyzing {len(documents)} documents in one batch: {list(documents_by_id)}")
+        response_content, complete = await run_extraction(build_batch_extraction_prompt(documents, user_question), on_citation=send_citation)
+        metrics.inc("analysis.batches")
+        metrics.inc("analysis.batched_documents", len(documents))
+
+        citation_fields = {document_id: [] for document_id in documents_by_id}
+        for fields in parse_citation_fields(response_content):
+            document = attribute(fields)
+            if document is None:
+                metrics.inc("analysis.unattributed_citations")
+                logger.warning(f"Dropping citation that matches none of the batched documents: {fields['text'][:100]}")
                 continue
-            citations.append(citation_dict)
+            citation_fields[str(document['document_id'])].append({field: fields[field] for field in CITATION_FIELDS})
+
+        results = []
+        for document in documents:
+            fields_list = citation_fields[str(document['document_id'])]
+            document_response = "<citations>\n" + "\n".join(format_citation_fields(fields) for fields in fields_list) + "\n</citations>"
+            if complete:
+                cache_key = analysis_cache_key(document['content'], user_question, openai_model, EXTRACTION_PROMPT_VERSION)
+                await analysis_cache.put(cache_key, openai_model, EXTRACTION_PROMPT_VERSION, document_response, fields_list)
+            await send_status(document, DocumentStatus.COMPLETE if complete else DocumentStatus.PARTIAL)
+            results.append((document, [build_citation(fields, document) for fields in fields_list]))
+
+        logger.info(f"Completed batch analysis for: {list(documents_by_id)}")
+        return results
+
     except Exception as e:
-        print(f"Error parsing XML: {e}")
-        print(f"Response: {response}")
-    return citations
+        for document in documents:
+            await send_status(document, DocumentStatus.ERROR, error=str(e))
+        raise
+
+class Speculation:
+    """Extraction started from the raw user message before Claude asks for it."""
+
+    def __init__(self, user_question: str):
+        self.user_question = user_question
+        self.planner: Optional[asyncio.Task] = None
+        self.tasks: List[asyncio.Task] = []
+
+    def cancel(self):
+        if self.planner:
+            self.planner.cancel()
+        for task in self.tasks:
+            task.cancel()
+
+# Keyed by conversation, and by analysis cache key so a tool call can pick up running work
+speculations: Dict[str, Speculation] = {}
+speculative_extractions: Dict[str, asyncio.Task] = {}
+
+def start_speculation(conversation_id: str, message: str, context: Dict[str, Any]):
+    previous = speculations.pop(conversation_id, None)
+    if previous:
+        previous.cancel()
+
+    speculation = Speculation(message)
+    speculation.planner = asyncio.create_task(plan_speculation(speculation, context))
+    speculations[conversation_id] = speculation
+    metrics.inc("speculation.started")
+
+async def plan_speculation(speculation: Speculation, context: Dict[str, Any]):
+    try:
+        # The turn is using its own session concurrently
+        async with AsyncSessionLocal() as db:
+            document_data = await select_documents(db, context, speculation.user_question)
+    except Exception as e:
+        logger.warning(f"Could not select documents to speculate on: {str(e)}")
+        return
+
+    current_job_size.set(len(document_data))
+    for document in document_data:
+        cache_key = analysis_cache_key(document['content'], speculation.user_question, openai_model, EXTRACTION_PROMPT_VERSION)
+        if cache_key in speculative_extractions:
+            continue
+        task = asyncio.create_task(speculate_document(document, speculation.user_question, cache_key))
+        speculative_extractions[cache_key] = task
+        task.add_done_callback(lambda task, cache_key=cache_key: speculative_extractions.pop(cache_key, None))
+        speculation.tasks.append(task)
+    logger.info(f"Speculatively analyzing {len(speculation.tasks)} documents")
+
+async def speculate_document(document: Dict, user_question: str, cache_key: str) -> Optional[str]:
+    try:
+        cached = await analysis_cache.get(cache_key)
+        if cached is not None:
+            return cached["response"]
+
+        if estimate_tokens(document['content'] or "") > ANALYSIS_CONTEXT_TOKENS:
+            async def discard(frame: str):
+                pass
+            response_content, complete = await analyze_document_windows(document, user_question, discard)
+        else:
+            response_content, complete = await run_extraction(build_extraction_prompt(document, user_question))
+        if not complete:
+            # Leave it to the tool call to run a full extraction
+            return None
+
+        citation_fields = parse_citation_fields(format_document_result(document, response_content))
+        await analysis_cache.put(cache_key, openai_model, EXTRACTION_PROMPT_VERSION, response_content, citation_fields)
+        return response_content
+    except asyncio.CancelledError:
+        metrics.inc("speculation.cancelled_documents")
+        raise
+    except Exception as e:
+        # The tool call will run the extraction itself
+        logger.warning(f"Speculative analysis of document {document['document_id']} failed: {str(e)}")
+        return None
+
+def parse_citation_fields(response: str) -> list[dict]:
+    # Empty citations are skipped by the parser
+    return parse_citations(response)
+
+def build_citation(fields: Dict, document: Dict) -> dict:
+    document_id = document['document_id']
+    return {
+        "id": hashlib.sha256(f"{document_id}-{fields['text']}".encode()).hexdigest()[:5],
+        "text": fields['text'],
+        "explanation": fields['explanation'],
+        "document_id": document_id,
+        "document_date": document['document_date'].strftime("%Y-%m-%d"),
+        "document_tags": document['document_tags'],
+        "document_filename": document['document_filename'],
+        "context": fields['context'],
+        "relevance_score": fields['relevance_score']
+    }
+
+def extract_citations_from_response(response: str, document: Dict) -> list[dict]:
+    return [build_citation(fields, document) for fields in parse_citation_fields(response)]
 
 def format_citations_output(citations: list[dict]) -> str:
     grouped_citations = {}
@@ -398,36 +1062,29 @@ def format_citations_output(citations: list[dict]) -> str:
     
     
 
-async def analyze_documents(user_question: str, context: Dict[str, Any], db: Session, conversation_id: str) -> str:
-    print(context)
+async def select_documents(db: AsyncSession, context: Dict[str, Any], user_question: str) -> List[Dict]:
     selected_tags = context.get('selectedTags', [])
     selected_documents = context.get('selectedDocuments', [])
 
     # Start with a base query
-    query = db.query(Document)
+    query = select(Document)
     
     if selected_tags:
-        query = query.filter(Document.tags.in_(selected_tags))
+        # Same matching as the document list the tags were picked from
+        query = query.where(tag_filter(tag_pairs(selected_tags)))
     if selected_documents:
-        query = query.filter(Document.id.in_([doc['id'] for doc in selected_documents]))
+        query = query.where(Document.id.in_([doc['id'] for doc in selected_documents]))
 
     # Add ordering
     query = query.order_by(Document.date.desc())
 
     # Execute the query
-    documents = query.all()
+    documents = (await db.execute(query)).scalars().all()
 
     print(f"Number of documents found: {len(documents)}")
     for doc in documents:
         print(f"Document ID: {doc.id}, Snippet: {doc.content[:100]}")
 
-    if not documents:
-        await websocket_manager.send_message(conversation_id, json.dumps({
-            "type": "document_analysis",
-            "status": "no_documents_found"
-        }), db)
-        return "No documents found for the selected criteria."
-
     # Prepare the document data for analysis
     document_data = [
         {
@@ -440,6 +1097,59 @@ async def analyze_documents(user_question: str, context: Dict[str, Any], db: Ses
         for doc in documents
     ]
 
+    # Only send the chunks most relevant to the question for long documents. Trimmed documents
+    # usually fit one window, so map-reduce over windows only runs for long documents without hits
+    long_document_ids = [doc['document_id'] for doc in document_data if estimate_tokens(doc['content'] or "") > RETRIEVAL_MIN_TOKENS]
+    if long_document_ids:
+        relevant_chunks = await top_chunks(db, long_document_ids, user_question, RETRIEVAL_TOP_K)
+        for doc in document_data:
+            if doc['document_id'] in relevant_chunks:
+                doc['content'] = "\n[...]\n".join(relevant_chunks[doc['document_id']])
+
+    return document_data
+
+async def plan_analysis_groups(document_data: List[Dict], user_question: str) -> tuple[List[List[Dict]], Optional[Dict[str, Dict]]]:
+    """Groups documents for analysis, returning the groups and the cache hits found while planning."""
+    # Queued jobs are per document and look themselves up, so packing only applies to inline analysis
+    if ANALYSIS_EXECUTION == "queue":
+        return [[doc] for doc in document_data], None
+
+    cache_keys = [analysis_cache_key(doc['content'], user_question, openai_model, EXTRACTION_PROMPT_VERSION) for doc in document_data]
+    cache_hits = await analysis_cache.get_many(cache_keys)
+
+    groups, small = [], []
+    for doc, cache_key in zip(document_data, cache_keys):
+        # Cached and speculatively started documents are cheaper to finish on their own
+        if (estimate_tokens(doc['content'] or "") > PACK_DOCUMENT_TOKENS
+                or cache_key in speculative_extractions
+                or cache_key in cache_hits):
+            groups.append([doc])
+        else:
+            small.append(doc)
+    return groups + pack_documents(small, PACK_BATCH_TOKENS, PACK_MAX_DOCUMENTS), cache_hits
+
+async def analyze_documents(user_question: str, context: Dict[str, Any], db: AsyncSession, conversation_id: str) -> str:
+    print(context)
+
+    speculation = speculations.pop(conversation_id, None)
+    if speculation and normalize_question(speculation.user_question) != normalize_question(user_question):
+        logger.info(f"Discarding speculative analysis for conversation {conversation_id}: question changed")
+        metrics.inc("speculation.discarded")
+        speculation.cancel()
+        speculation = None
+    elif speculation:
+        # Let it register its extractions so documents aren't analyzed twice
+        await asyncio.gather(asyncio.shield(speculation.planner), return_exceptions=True)
+
+    document_data = await select_documents(db, context, user_question)
+
+    if not document_data:
+        await websocket_manager.send_message(conversation_id, json.dumps({
+            "type": "document_analysis",
+            "status": "no_documents_found"
+        }))
+        return "No documents found for the selected criteria."
+
     total_documents = len(document_data)
     logger.info(f"Total documents to analyze: {total_documents}")
 
@@ -457,32 +1167,72 @@ async def analyze_documents(user_question: str, context: Dict[str, Any], db: Ses
             }
             for doc in document_data
         ]
-    }), db)
-
-    # Analyze each document concurrently
-    analysis_tasks = [analyze_single_document(doc, user_question, conversation_id, db) for doc in document_data]
-    analysis_results = await asyncio.gather(*analysis_tasks)
+    }))
+
+    async def analyze_and_report(docs: List[Dict]) -> List[tuple[Dict, list[dict], Optional[Exception]]]:
+        try:
+            if len(docs) > 1:
+                return [(doc, citations, None) for doc, citations in await analyze_document_batch(docs, user_question, conversation_id)]
+            if ANALYSIS_EXECUTION == "queue":
+                result, citations = await run_analysis_job(docs[0], user_question, conversation_id, partial(websocket_manager.send_message, conversation_id))
+            else:
+                result, citations = await analyze_single_document(docs[0], user_question, conversation_id, cache_hits=cache_hits)
+            return [(docs[0], citations, None)]
+        except Exception as e:
+            return [(doc, [], e) for doc in docs]
+
+    # Sub-agent calls from small analyses get priority in the fair scheduler
+    current_job_size.set(total_documents)
+
+    # Analyze each document (or batch of small ones) concurrently, pushing citations as each one finishes
+    groups, cache_hits = await plan_analysis_groups(document_data, user_question)
+    analysis_tasks = [asyncio.create_task(analyze_and_report(docs)) for docs in groups]
+    all_citations = []
+    document_statuses = {}
+    try:
+        for next_result in asyncio.as_completed(analysis_tasks):
+            for doc, citations, error in await next_result:
+                if error is not None:
+                    logger.error(f"Analysis failed for document {doc['document_id']}: {str(error)}")
+                    document_statuses[doc['document_id']] = DocumentStatus.ERROR
+                    continue
+
+                document_statuses[doc['document_id']] = DocumentStatus.COMPLETE
+                all_citations.extend(citations)
+                await websocket_manager.send_message(conversation_id, json.dumps({
+                    "type": "partial_citations",
+                    "document_id": doc['document_id'],
+                    "completed_documents": list(document_statuses.values()).count(DocumentStatus.COMPLETE),
+                    "total_documents": total_documents,
+                    "citations": citations
+                }))
+    except asyncio.CancelledError:
+        metrics.inc("analysis.cancelled_documents", sum(1 for task in analysis_tasks if not task.done()))
+        raise
+    finally:
+        for task in analysis_tasks:
+            task.cancel()
+        if speculation:
+            # Anything still running was not part of this analysis
+            speculation.cancel()
 
-    completed_documents = len(analysis_results)
+    completed_documents = sum(1 for status in document_statuses.values() if status == DocumentStatus.COMPLETE)
     logger.info(f"Completed documents: {completed_documents}")
 
-    all_citations = []
-
-    for result, document in analysis_results:
-        citations = extract_citations_from_response(result, document)
-        all_citations.extend(citations)
+    if completed_documents == 0:
+        raise RuntimeError(f"Analysis failed for all {total_documents} documents")
 
     await websocket_manager.send_message(conversation_id, json.dumps({
         "type": "document_analysis_complete",
         "status": "complete",
         "total_documents": total_documents,
         "completed_documents": completed_documents
-    }), db)
+    }))
 
     await websocket_manager.send_message(conversation_id, json.dumps({
         "type": "citations",
         "citations": all_citations
-    }), db)
+    }))
 
     complete_document_analysis = {
         "type": "document_analysis",
@@ -494,23 +1244,23 @@ async def analyze_documents(user_question: str, context: Dict[str, Any], db: Ses
                 "document_filename": doc['document_filename'],
                 "document_id": doc['document_id'],
                 "document_tags": doc['document_tags'],
-                "status": DocumentStatus.COMPLETE.value
+                "status": document_statuses[doc['document_id']].value
             }
             for doc in document_data
         ],
         "citations": all_citations
     }
 
-    await websocket_manager.send_message(conversation_id, json.dumps(complete_document_analysis), db)
+    await websocket_manager.send_message(conversation_id, json.dumps(complete_document_analysis))
 
-    chat_manager.add_message(db, conversation_id, {
+    await chat_manager.add_message(db, conversation_id, {
         "role": "document_analysis",
         "content": complete_document_analysis
     })
 
     return format_citations_output(all_citations)
 
-async def handle_tool_call(tool_call: Dict, context: Dict, db: Session, conversation_id: str) -> Dict:
+async def handle_tool_call(tool_call: Dict, context: Dict, db: AsyncSession, conversation_id: str) -> Dict:
     tool_name = tool_call['name']
     tool_input = tool_call['input']
     
@@ -518,7 +1268,7 @@ async def handle_tool_call(tool_call: Dict, context: Dict, db: Session, conversa
         "type": "tool_call_start",
         "tool_name": tool_name,
         "tool_input": tool_input
-    }), db)
+    }))
     
     try:
         if tool_name == "analyze_documents":
@@ -534,6 +1284,8 @@ async def handle_tool_call(tool_call: Dict, context: Dict, db: Session, conversa
                 "content": f"Unknown tool called: {tool_name}",
                 "is_error": True
             }
+    except ConversationNotFound:
+        raise
     except Exception as e:
         print(e)
         tool_result = {
@@ -546,11 +1298,11 @@ async def handle_tool_call(tool_call: Dict, context: Dict, db: Session, conversa
         "type": "tool_call_end",
         "tool_name": tool_name,
         "tool_result": tool_result
-    }), db)
+    }))
     
     return tool_result
 
-async def process_message(message: str, context: Dict[str, Any], db: Session, conversation_id: str) -> None:
+async def process_message(message: str, context: Dict[str, Any], db: AsyncSession, conversation_id: str) -> None:
     print(context)
 
     selected_tags = context.get('selectedTags', [])
@@ -683,65 +1435,157 @@ The goal is to thoroughly and objectively analyze the documents and provide the
         },
     ]
 
-    chat_manager.add_message(db, conversation_id, {"role": "user", "content": [{"type": "text", "text": message}]})
+    if SPECULATIVE_ANALYSIS and (selected_tags or selected_documents):
+        start_speculation(conversation_id, message, context)
+
+    await chat_manager.add_message(db, conversation_id, {"role": "user", "content": [{"type": "text", "text": message}]})
     
     assistant_message = {"role": "assistant", "content": []}
     current_text = ""
+    coalescer = DeltaCoalescer(lambda text: websocket_manager.send_delta(conversation_id, text))
+
+    pending_tool_use_id = None
+    turn_saved = False
 
-    while True:
-        messages = chat_manager.get_history(db, conversation_id)
-        async for chunk in stream_response(anthropic_client, messages, system_prompt, tools):
-            chunk_data = json.loads(chunk) if chunk.startswith('{') else {"text": chunk}
+    try:
+        while True:
+            messages = compact_history(await chat_manager.get_history(db, conversation_id))
+            async for chunk in stream_response(anthropic_client, messages, system_prompt, tools):
+                chunk_data = json.loads(chunk) if chunk.startswith('{') else {"text": chunk}
             
-            if "text" in chunk_data:
-                current_text += chunk_data["text"]
-                structured_text = json.dumps({
-                    "type": "assistant_message",
-                    "content": chunk_data["text"]
-                })
-                await websocket_manager.send_message(conversation_id, structured_text, db)
-            elif "tool_use" in chunk_data:
-                if current_text:
-                    assistant_message["content"].append({"type": "text", "text": current_text})
-                    current_text = ""
+                if "text" in chunk_data:
+                    current_text += chunk_data["text"]
+                    await coalescer.add(chunk_data["text"])
+                elif "tool_use" in chunk_data:
+                    await coalescer.flush()
+                    if current_text:
+                        assistant_message["content"].append({"type": "text", "text": current_text})
+                        current_text = ""
                 
-                tool_call = chunk_data["tool_use"]
-                assistant_message["content"].append({
-                    "type": "tool_use",
-                    "id": tool_call["id"],
-                    "name": tool_call["name"],
-                    "input": tool_call["input"]
-                })
+                    tool_call = chunk_data["tool_use"]
+                    assistant_message["content"].append({
+                        "type": "tool_use",
+                        "id": tool_call["id"],
+                        "name": tool_call["name"],
+                        "input": tool_call["input"]
+                    })
                 
-                chat_manager.add_message(db, conversation_id, assistant_message)
+                    pending_tool_use_id = tool_call["id"]
+                    await chat_manager.add_message(db, conversation_id, assistant_message)
                 
-                tool_result = await handle_tool_call(tool_call, context, db, conversation_id)
+                    tool_result = await handle_tool_call(tool_call, context, db, conversation_id)
                 
-                chat_manager.add_message(db, conversation_id, {
+                    await chat_manager.add_message(db, conversation_id, {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "tool_result",
+                                "tool_use_id": tool_result["tool_use_id"],
+                                "content": tool_result["content"],
+                                "is_error": tool_result["is_error"]
+                            }
+                        ]
+                    })
+                    pending_tool_use_id = None
+
+                    assistant_message = {"role": "assistant", "content": []}
+                    break
+            else:
+                if current_text:
+                    assistant_message["content"].append({"type": "text", "text": current_text})
+                    current_text = ""
+                await chat_manager.add_message(db, conversation_id, assistant_message)
+                turn_saved = True
+                break
+    except asyncio.CancelledError:
+        if not turn_saved:
+            await save_cancelled_turn(conversation_id, assistant_message, current_text, pending_tool_use_id)
+        raise
+    finally:
+        # Buffered text, or a timer flush in flight, must not land after the end_of_response frame
+        await coalescer.flush()
+
+    await websocket_manager.send_message(conversation_id, json.dumps({
+        "type": "end_of_response"
+    }))
+
+async def save_cancelled_turn(conversation_id: str, assistant_message: Dict, current_text: str, pending_tool_use_id: Optional[str]):
+    content = assistant_message["content"] + ([{"type": "text", "text": current_text}] if current_text else [])
+    # The turn's own session may have been interrupted mid-query, so use a fresh one
+    async with AsyncSessionLocal() as db:
+        last_message = (await db.execute(
+            select(Message)
+            .where(Message.conversation_id == conversation_id, Message.role.in_(['user', 'assistant']))
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .limit(1)
+        )).scalars().first()
+        if pending_tool_use_id:
+            # Every persisted tool_use needs a matching tool_result or the history is rejected
+            if last_message and last_message.role == "assistant" and any(block.get("id") == pending_tool_use_id for block in last_message.content):
+                await chat_manager.add_message(db, conversation_id, {
                     "role": "user",
                     "content": [
                         {
                             "type": "tool_result",
-                            "tool_use_id": tool_result["tool_use_id"],
-                            "content": tool_result["content"],
-                            "is_error": tool_result["is_error"]
+                            "tool_use_id": pending_tool_use_id,
+                            "content": "Cancelled before the tool finished.",
+                            "is_error": True
                         }
                     ]
                 })
-
-
-                
-                assistant_message = {"role": "assistant", "content": []}
-                break
-        else:
-            if current_text:
-                assistant_message["content"].append({"type": "text", "text": current_text})
-            chat_manager.add_message(db, conversation_id, assistant_message)
-            break
-
-    await websocket_manager.send_message(conversation_id, json.dumps({
-        "type": "end_of_response"
-    }), db)
+        # The cancel may have landed while the final message was being committed
+        elif content and not (last_message and last_message.role == "assistant" and last_message.content == content):
+            await chat_manager.add_message(db, conversation_id, {"role": "assistant", "content": content})
+
+    # The cancel may have landed between a commit and its cache append, reload from the database next time
+    chat_manager.invalidate(conversation_id)
+
+async def run_turn(message: str, context: Dict[str, Any], conversation_id: str, user_id: int) -> None:
+    start = time.monotonic()
+    current_user_id.set(user_id)
+    # Lets other workers route stops here and ask for the journal before replaying
+    backplane.publish_control(conversation_id, "turn_started")
+    try:
+        # The turn outlives the socket that started it, so it can't use the request's session
+        async with AsyncSessionLocal() as db:
+            try:
+                await process_message(message, context, db, conversation_id)
+            except asyncio.CancelledError:
+                metrics.inc("turns.cancelled")
+                metrics.observe("turns.cancelled_after", time.monotonic() - start)
+                logger.info(f"Cancelled turn for conversation {conversation_id}")
+                await db.rollback()
+                try:
+                    await websocket_manager.send_message(conversation_id, json.dumps({
+                        "type": "end_of_response",
+                        "cancelled": True
+                    }))
+                except ConversationNotFound:
+                    pass
+                raise
+            except ConversationNotFound:
+                # Deleted mid-turn, there is nobody left to tell
+                metrics.inc("turns.conversation_deleted")
+                logger.info(f"Conversation {conversation_id} was deleted during its turn")
+                await db.rollback()
+            except Exception as e:
+                logger.error(f"Error processing message: {str(e)}")
+                await db.rollback()
+                await websocket_manager.send_message(conversation_id, json.dumps({
+                    "type": "end_of_response",
+                    "error": str(e)
+                }))
+    finally:
+        # Claude never asked for the speculated analysis
+        speculation = speculations.pop(conversation_id, None)
+        if speculation:
+            speculation.cancel()
+        if active_turns.get(conversation_id) is asyncio.current_task():
+            active_turns.pop(conversation_id, None)
+            clear_turn_cancellation(conversation_id)
+            # Replays elsewhere stop asking us once the turn ends, so its frames must be written by then
+            await websocket_journal.flush()
+            backplane.publish_control(conversation_id, "turn_ended")
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -749,8 +1593,8 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user or not verify_password(password, user.hashed_password):
         return False
     return user
@@ -765,7 +1609,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -778,7 +1622,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if user is None:
         raise credentials_exception
     return user
@@ -786,32 +1630,32 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
 @router.post("/conversations")
 async def create_conversation(
     title: str = "New Conversation",
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     logger.info(f"Creating new conversation: {title} for user {current_user.id}")
     new_conversation = Conversation(title=title, user_id=current_user.id)
     db.add(new_conversation)
-    db.commit()
-    db.refresh(new_conversation)
+    await db.commit()
+    await db.refresh(new_conversation)
     logger.info(f"New conversation created: {new_conversation.id}")
     return new_conversation.to_dict()
 
 @router.get("/conversations")
 async def list_conversations(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    conversations = db.query(Conversation).filter(Conversation.user_id == current_user.id).order_by(Conversation.updated_at.desc()).all()
+    conversations = (await db.execute(select(Conversation).where(Conversation.user_id == current_user.id).order_by(Conversation.updated_at.desc()))).scalars().all()
     return [conversation.to_dict() for conversation in conversations]
 
 @router.get("/conversations/{conversation_id}")
 async def get_conversation(
     conversation_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id, Conversation.user_id == current_user.id).first()
+    conversation = (await db.execute(select(Conversation).where(Conversation.id == conversation_id, Conversation.user_id == current_user.id))).scalars().first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     return conversation.to_dict()
@@ -819,14 +1663,15 @@ async def get_conversation(
 @router.delete("/conversations/{conversation_id}")
 async def delete_conversation(
     conversation_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id, Conversation.user_id == current_user.id).first()
+    conversation = (await db.execute(select(Conversation).where(Conversation.id == conversation_id, Conversation.user_id == current_user.id))).scalars().first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    db.delete(conversation)
-    db.commit()
+    await db.delete(conversation)
+    await db.commit()
+    chat_manager.invalidate(conversation_id)
     return {"message": "Conversation deleted successfully"}
 
 class TitleUpdate(BaseModel):
@@ -836,36 +1681,36 @@ class TitleUpdate(BaseModel):
 async def update_conversation_title(
     conversation_id: int,
     title_update: TitleUpdate = Body(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     logger.info(f"Received title update request for conversation {conversation_id}: {title_update.dict()}")
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id, Conversation.user_id == current_user.id).first()
+    conversation = (await db.execute(select(Conversation).where(Conversation.id == conversation_id, Conversation.user_id == current_user.id))).scalars().first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     conversation.title = title_update.title
-    db.commit()
-    db.refresh(conversation)
+    await db.commit()
+    await db.refresh(conversation)
     return conversation.to_dict()
 
 @router.post("/register")
-async def register_user(username: str, email: str, password: str, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == username).first()
+async def register_user(username: str, email: str, password: str, db: AsyncSession = Depends(get_async_db)):
+    db_user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    db_user = db.query(User).filter(User.email == email).first()
+    db_user = (await db.execute(select(User).where(User.email == email))).scalars().first()
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     hashed_password = get_password_hash(password)
     new_user = User(username=username, email=email, hashed_password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user.to_dict()
 
 @router.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -882,8 +1727,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 async def websocket_endpoint(
     websocket: WebSocket,
     conversation_id: str = None,
-    db: Session = Depends(get_db),
-    token: str = Query(None)
+    db: AsyncSession = Depends(get_async_db),
+    token: str = Query(None),
+    last_seq: Optional[int] = Query(None)
 ):
     if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
@@ -898,40 +1744,65 @@ async def websocket_endpoint(
     if conversation_id == "null":
         new_conversation = Conversation(title="New Conversation", user_id=current_user.id)
         db.add(new_conversation)
-        db.commit()
-        db.refresh(new_conversation)
-        conversation_id = str(new_conversation.id)
+        await db.commit()
+        await db.refresh(new_conversation)
+        conversation_id = new_conversation.id
+    elif conversation_id.isdigit():
+        conversation_id = int(conversation_id)
+    else:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id, Conversation.user_id == current_user.id).first()
+    conversation = (await db.execute(select(Conversation).where(Conversation.id == conversation_id, Conversation.user_id == current_user.id))).scalars().first()
     if not conversation:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    await websocket_manager.connect(websocket, conversation_id, str(current_user.id), db)
+    sender = await websocket_manager.connect(websocket, conversation_id, str(current_user.id), db, last_seq)
+    clear_turn_cancellation(conversation_id)
     try:
         # Send the conversation ID to the client
-        await websocket.send_json({"type": "conversation_created", "id": conversation_id})
+        websocket_manager.send_to(conversation_id, str(current_user.id), json.dumps({"type": "conversation_created", "id": str(conversation_id)}))
 
         while True:
             data = await websocket.receive_json()
             
             # Store incoming message
-            websocket_message = WebSocketMessage(
-                conversation_id=conversation_id,
-                message_type="user",
-                content=json.dumps(data)
-            )
-            db.add(websocket_message)
-            db.commit()
+            await websocket_journal.record(conversation_id, "user", json.dumps(data))
+
+            if data.get('type') == 'load_history':
+                # A turn may be using the connection's session, page on a separate one
+                try:
+                    async with AsyncSessionLocal() as history_db:
+                        await websocket_manager.send_conversation_history(conversation_id, str(current_user.id), history_db, data.get('cursor'))
+                except ValueError:
+                    websocket_manager.send_to(conversation_id, str(current_user.id), json.dumps({"type": "error", "message": "Invalid history cursor"}))
+                continue
+
+            if data.get('type') == 'stop':
+                owner = websocket_manager.remote_turns.get(conversation_id)
+                if conversation_id not in active_turns and owner:
+                    backplane.publish_control(conversation_id, "stop", target=owner)
+                else:
+                    stop_turn(conversation_id)
+                continue
+
+            if conversation_id in active_turns:
+                websocket_manager.send_to(conversation_id, str(current_user.id), json.dumps({"type": "error", "message": "A response is already in progress"}))
+                continue
 
             message = data['message']
             context = data['context']
             
-            await process_message(message, context, db, conversation_id)
+            active_turns[conversation_id] = asyncio.create_task(run_turn(message, context, conversation_id, current_user.id))
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for conversation {conversation_id}")
     except Exception as e:
         logger.error(f"Error in WebSocket: {str(e)}")
     finally:
-        websocket_manager.disconnect(conversation_id, str(current_user.id))
+        websocket_manager.disconnect(conversation_id, str(current_user.id), sender)
+        # Nobody is left to read the answer, stop spending tokens on it unless they come back soon
+        if not websocket_manager.has_connections(conversation_id):
+            schedule_turn_cancellation(conversation_id)
+        await websocket_journal.flush()
 
@@ -0,0 +1,74 @@
+import html
+import re
+from typing import Dict, List
+
+CITATION_FIELDS = ("text", "explanation", "context", "relevance_score")
+# Only present in output from batched prompts covering several documents
+ATTRIBUTION_FIELDS = ("document_id",)
+
+CITATION_OPEN = re.compile(r"<citation\b[^>]*>", re.IGNORECASE)
+CITATION_CLOSE = re.compile(r"</citation\s*>", re.IGNORECASE)
+FIELD_PATTERNS = {
+    field: re.compile(rf"<{field}\b[^>]*>(.*?)</{field}\s*>", re.IGNORECASE | re.DOTALL)
+    for field in CITATION_FIELDS + ATTRIBUTION_FIELDS
+}
+TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+class IncrementalCitationParser:
+    """Extracts `<citation>` elements from extraction output as it streams in.
+
+    Each citation is returned by `feed` as soon as its closing tag arrives.
+    Nothing outside a complete citation element is ever parsed, so malformed
+    or truncated output only loses the citation it breaks.
+    """
+
+    def __init__(self):
+        self.citations: List[Dict] = []
+        self._buffer = ""
+        self._scan_from = 0
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self._buffer += chunk
+        found = []
+        while True:
+            close = CITATION_CLOSE.search(self._buffer, self._scan_from)
+            if close is None:
+                # Keep enough of the tail to match a closing tag split across chunks
+                self._scan_from = max(0, len(self._buffer) - len("</citation >"))
+                break
+
+            opening = None
+            for opening in CITATION_OPEN.finditer(self._buffer, 0, close.start()):
+                pass
+            if opening is not None:
+                fields = parse_citation_body(self._buffer[opening.end():close.start()])
+                if fields["text"]:
+                    found.append(fields)
+
+            self._buffer = self._buffer[close.end():]
+            self._scan_from = 0
+
+        self.citations.extend(found)
+        return found
+
+
+def parse_citation_body(body: str) -> Dict:
+    fields = {}
+    for field, pattern in FIELD_PATTERNS.items():
+        match = pattern.search(body)
+        fields[field] = html.unescape(TAG_PATTERN.sub("", match.group(1))) if match else ""
+    return fields
+
+
+def format_citation_fields(fields: Dict) -> str:
+    return "<citation>" + "".join(
+        f"<{field}>{html.escape(fields.get(field) or '', quote=False)}</{field}>"
+        for field in CITATION_FIELDS
+    ) + "</citation>"
+
+
+def parse_citations(response: str) -> List[Dict]:
+    parser = IncrementalCitationParser()
+    parser.feed(response)
+    return parser.citations
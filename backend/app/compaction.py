@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, List
+
+from .metrics import metrics
+from .utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "60000"))
+# The most recent user turns are always sent verbatim
+HISTORY_KEEP_RECENT_TURNS = int(os.getenv("HISTORY_KEEP_RECENT_TURNS", "2"))
+COMPACTED_CITATION_CHARS = 160
+STUB_CACHE_SIZE = 1024
+
+DOCUMENT_RESULT_PATTERN = re.compile(r"<document_result>(.*?)</document_result>", re.DOTALL)
+CITATION_PATTERN = re.compile(r"<citation>\s*<id>(.*?)</id>\s*<text>(.*?)</text>", re.DOTALL)
+FIELD_PATTERNS = {
+    field: re.compile(rf"<{field}>(.*?)</{field}>", re.DOTALL)
+    for field in ("document_id", "document_date", "document_filename")
+}
+
+_stub_cache: OrderedDict[str, str] = OrderedDict()
+
+
+def message_tokens(message: Dict) -> int:
+    content = message["content"]
+    return estimate_tokens(content if isinstance(content, str) else json.dumps(content))
+
+
+def history_tokens(messages: List[Dict]) -> int:
+    return sum(message_tokens(message) for message in messages)
+
+
+def compact_tool_result(content: str) -> str:
+    """Shrink an analyze_documents result down to its citation ids and short excerpts."""
+    documents = []
+    for document_result in DOCUMENT_RESULT_PATTERN.findall(content):
+        fields = {}
+        for field, pattern in FIELD_PATTERNS.items():
+            match = pattern.search(document_result)
+            fields[field] = match.group(1) if match else ""
+
+        citations = []
+        for citation_id, text in CITATION_PATTERN.findall(document_result):
+            excerpt = " ".join(text.split())
+            if len(excerpt) > COMPACTED_CITATION_CHARS:
+                excerpt = excerpt[:COMPACTED_CITATION_CHARS] + "..."
+            citations.append(f'<citation id="{citation_id}">{excerpt}</citation>')
+
+        documents.append(
+            f"<document_result><document_id>{fields['document_id']}</document_id>"
+            f"<document_date>{fields['document_date']}</document_date>"
+            f"<document_filename>{fields['document_filename']}</document_filename>\n"
+            + "\n".join(citations)
+            + "\n</document_result>"
+        )
+
+    return (
+        "<compacted_results>\n"
+        "Earlier analyze_documents results, shortened to save context. The citation ids are still valid to cite; "
+        "call analyze_documents again if the full text is needed.\n"
+        + "\n".join(documents)
+        + "\n</compacted_results>"
+    )
+
+
+def _compact_block(block: Dict) -> Dict:
+    if block.get("type") != "tool_result" or block.get("is_error") or not isinstance(block.get("content"), str):
+        return block
+
+    tool_use_id = block["tool_use_id"]
+    stub = _stub_cache.get(tool_use_id)
+    if stub is None:
+        stub = compact_tool_result(block["content"])
+        _stub_cache[tool_use_id] = stub
+        while len(_stub_cache) > STUB_CACHE_SIZE:
+            _stub_cache.popitem(last=False)
+    else:
+        _stub_cache.move_to_end(tool_use_id)
+
+    return {**block, "content": stub}
+
+
+def compact_history(messages: List[Dict], budget: int = HISTORY_TOKEN_BUDGET, keep_recent_turns: int = HISTORY_KEEP_RECENT_TURNS) -> List[Dict]:
+    """Replace old tool results with citation stubs until the history fits in `budget` tokens.
+
+    Messages are never dropped or reordered, so tool_use/tool_result pairs
+    stay intact. The input list and its messages are not modified.
+    """
+    tokens_before = history_tokens(messages)
+    if tokens_before <= budget:
+        return messages
+
+    # A turn starts at a user message that carries text rather than tool results
+    turn_starts = [
+        index for index, message in enumerate(messages)
+        if message["role"] == "user" and (
+            isinstance(message["content"], str) or any(block.get("type") == "text" for block in message["content"])
+        )
+    ]
+    if keep_recent_turns <= 0:
+        boundary = len(messages)
+    elif len(turn_starts) < keep_recent_turns:
+        # Every turn is recent, including the one that produced the latest results
+        boundary = 0
+    else:
+        boundary = turn_starts[-keep_recent_turns]
+
+    compacted = list(messages)
+    tokens = tokens_before
+    for index in range(boundary):
+        if tokens <= budget:
+            break
+        message = compacted[index]
+        if message["role"] != "user" or isinstance(message["content"], str):
+            continue
+        if not any(block.get("type") == "tool_result" for block in message["content"]):
+            continue
+        replacement = {**message, "content": [_compact_block(block) for block in message["content"]]}
+        tokens += message_tokens(replacement) - message_tokens(message)
+        compacted[index] = replacement
+
+    metrics.inc("history_compaction.runs")
+    metrics.inc("history_compaction.tokens_before", tokens_before)
+    metrics.inc("history_compaction.tokens_after", tokens)
+    logger.info(f"Compacted history from ~{tokens_before} to ~{tokens} tokens (budget {budget})")
+    if tokens > budget:
+        logger.warning(f"History still exceeds the token budget after compaction: ~{tokens} > {budget}")
+    return compacted
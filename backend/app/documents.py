@@ -1,29 +1,42 @@
+import asyncio
 import json
+import logging
+import os
+import shutil
+import tempfile
+import time
 from datetime import datetime
-from io import BytesIO
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Set
 
-import magic
 from fastapi import (
     APIRouter,
     Body,
     Depends,
-    File,
-    Form,
     HTTPException,
     Path,
     Query,
-    UploadFile,
+    Request,
 )
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from pypdf import PdfReader
+from starlette.background import BackgroundTask
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from .chat import get_current_user
-from .database import get_db
-from .models import Document, User
+from .database import AsyncSessionLocal, get_async_db, get_db
+from .ingest import extract_text, spool_bulk_upload, spool_upload, text_hash, upload_slot
+from .metrics import metrics
+from .models import Document, DocumentTag, User
+from .retrieval import chunk_totals_query, corpus_stats_statement, index_document, update_corpus_stats
+from .tags import parse_tag_filters, replace_tags_statements, tag_filter
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+BULK_EXTRACTION_CONCURRENCY = int(os.getenv("BULK_EXTRACTION_CONCURRENCY", "8"))
+BULK_INSERT_BATCH = int(os.getenv("BULK_INSERT_BATCH", "50"))
 
 class TagModel(BaseModel):
     key: str
@@ -32,35 +45,35 @@ class TagModel(BaseModel):
 @router.get("/")
 async def get_documents(
     tags: List[str] = Query(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    query = db.query(Document)
+    query = select(Document.id, Document.document_filename, Document.tags)
 
     if tags:
-        for tag in tags:
-            key, value = tag.split(':')
-            query = query.filter(Document.tags.contains({key: value}))
+        try:
+            query = query.where(tag_filter(parse_tag_filters(tags)))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    documents = query.all()
+    documents = (await db.execute(query)).all()
     return {"documents": [{"id": doc.id, "filename": doc.document_filename, "tags": doc.tags} for doc in documents]}
 
 @router.get("/tags")
 async def get_available_tags(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    # Fetch all documents' tags
-    documents = db.query(Document.tags).all()
+    rows = (await db.execute(
+        select(DocumentTag.key, DocumentTag.value, func.count(DocumentTag.document_id))
+        .group_by(DocumentTag.key, DocumentTag.value)
+        .order_by(DocumentTag.key, DocumentTag.value)
+    )).all()
     
-    unique_tags = set()
-    for doc in documents:
-        if doc.tags:  # Check if tags is not None
-            for tag in doc.tags:
-                for key, value in tag.items():
-                    unique_tags.add(f"{key}:{value}")
-    
-    return {"tags": list(unique_tags)}
+    return {
+        "tags": [f"{key}:{value}" for key, value, _ in rows],
+        "counts": [{"key": key, "value": value, "count": count} for key, value, count in rows],
+    }
 
 @router.get("/{document_id}")
 def get_document_by_id(
@@ -77,56 +90,235 @@ def get_document_by_id(
 
 @router.post("/upload")
 async def upload_document(
-    file: UploadFile = File(...),
-    tags: str = Form(...),  # Tags will be sent as a JSON string
-    db: Session = Depends(get_db),
+    request: Request,  # multipart "file", and "tags" as a JSON string
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    content = await file.read()
-    
-    mime = magic.Magic(mime=True)
-    file_type = mime.from_buffer(content)
-    
-    if file_type == "application/pdf":
-        text = extract_text_from_pdf(content)
-    elif file_type.startswith("text/"):
-        text = content.decode("utf-8")
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported file type")
-    
-    # Parse and validate tags
-    try:
-        parsed_tags = json.loads(tags)
-        if not isinstance(parsed_tags, list):
-            raise ValueError("Tags must be a list")
-        for tag in parsed_tags:
-            if not isinstance(tag, dict) or 'key' not in tag or 'value' not in tag:
-                raise ValueError("Each tag must be a dictionary with 'key' and 'value'")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON format for tags")
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    # Stream the upload to disk and extract from there, a few uploads at a time
+    async with upload_slot(), spool_upload(request) as (fields, upload):
+        if "tags" not in fields:
+            raise HTTPException(status_code=400, detail="Missing tags")
+        parsed_tags = parse_tags(fields["tags"])
+        document_filename = upload["filename"]
+        content_hash = upload["content_hash"]
+        existing = await find_hashes(db, Document.content_hash, {content_hash})
+        if not existing:
+            text, extraction = await extract_text(upload["path"], upload["mime"])
+            document_text_hash = text_hash(text)
+            existing = await find_hashes(db, Document.text_hash, {document_text_hash})
+
+    if existing:
+        # Same bytes or same text as a stored document, don't extract, index or analyze it twice
+        metrics.inc("uploads.duplicates")
+        document = await db.get(Document, next(iter(existing.values())))
+        return {"message": "Document already exists", "duplicate": True, "document": document.to_dict()}
     
     new_document = Document(
         date=datetime.now().date(),
         content=text,
-        document_filename=file.filename,
-        tags=parsed_tags
+        document_filename=document_filename,
+        tags=parsed_tags,
+        content_hash=content_hash,
+        text_hash=document_text_hash,
     )
     
     db.add(new_document)
-    db.commit()
-    db.refresh(new_document)
+    await db.flush()
+    for statement in replace_tags_statements([new_document]):
+        await db.execute(statement)
+    chunk_count, total_terms = await index_document(db, new_document)
+    await db.commit()
+    await update_corpus_stats(db, chunk_count, total_terms)
+    await db.refresh(new_document)
     
-    return {"message": "Document uploaded successfully", "document": new_document.to_dict()}
+    response = {"message": "Document uploaded successfully", "document": new_document.to_dict()}
+    if extraction is not None:
+        response["extraction"] = {key: extraction[key] for key in ("pages", "seconds", "page_seconds", "page_errors")}
+    return response
+
+@router.post("/upload/bulk")
+async def upload_documents_bulk(
+    request: Request,  # multipart "files", "tags" applied to every file and "file_tags", both as JSON strings
+    current_user: User = Depends(get_current_user)
+):
+    # The body is streamed straight to disk, so spool everything before streaming the results
+    directory = tempfile.mkdtemp(prefix="bulk-upload-")
+    try:
+        async with upload_slot():
+            fields, entries = await spool_bulk_upload(request, directory)
+        common_tags = parse_tags(fields.get("tags", "[]"))
+        per_file = parse_file_tags(fields.get("file_tags", "{}"))
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    return StreamingResponse(
+        bulk_ingest(entries, common_tags, per_file),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(shutil.rmtree, directory, ignore_errors=True),
+    )
+
+async def bulk_ingest(entries: List[Dict], common_tags: List[Dict], file_tags: Dict[str, List[Dict]]) -> AsyncIterator[str]:
+    """Extracts spooled files in parallel and stores them in batches, yielding one NDJSON line per file event.
+
+    Files whose bytes or extracted text match an existing document, or an
+    earlier file in the same upload, are reported as duplicates and skipped.
+    """
+    started = time.perf_counter()
+    total = len(entries)
+    extraction_slots = asyncio.Semaphore(BULK_EXTRACTION_CONCURRENCY)
+    counts = {"stored": 0, "duplicates": 0, "errors": 0}
+    # Hash -> filename of the first file in this upload stored with it
+    seen_content, seen_text = {}, {}
+
+    def progress(entry: Dict, status: str, **extra) -> str:
+        return json.dumps({"filename": entry["filename"], "status": status, "total": total, **extra}) + "\n"
+
+    async def extract(entry: Dict):
+        if "error" in entry:
+            return entry, None, entry["error"]
+        if entry["content_hash"] in existing_content or entry["content_hash"] in seen_content:
+            return entry, None, None
+
+        async with extraction_slots:
+            try:
+                text, _ = await extract_text(entry["path"], entry["mime"])
+                return entry, text, None
+            except HTTPException as e:
+                return entry, None, e.detail
+            except Exception as e:
+                return entry, None, str(e)
+
+    def duplicate(entry: Dict, document_id: Optional[int], duplicate_of: Optional[str]) -> str:
+        counts["duplicates"] += 1
+        metrics.inc("uploads.duplicates")
+        if document_id is not None:
+            return progress(entry, "duplicate", document_id=document_id)
+        return progress(entry, "duplicate", duplicate_of=duplicate_of)
+
+    async def store(db: AsyncSession, batch: List[tuple[Dict, Document]]) -> List[str]:
+        lines = []
+        existing_text = await find_hashes(db, Document.text_hash, {document.text_hash for _, document in batch})
+        if existing_text:
+            lines = [duplicate(entry, existing_text[document.text_hash], None) for entry, document in batch if document.text_hash in existing_text]
+            batch = [(entry, document) for entry, document in batch if document.text_hash not in existing_text]
+            if not batch:
+                return lines
+
+        try:
+            db.add_all([document for _, document in batch])
+            await db.flush()
+            for statement in replace_tags_statements([document for _, document in batch]):
+                await db.execute(statement)
+            stats_changes = [await index_document(db, document) for _, document in batch]
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Failed to store batch of {len(batch)} uploaded documents: {str(e)}")
+            # Later copies of these files are not duplicates of anything stored
+            for _, document in batch:
+                seen_content.pop(document.content_hash, None)
+                seen_text.pop(document.text_hash, None)
+            counts["errors"] += len(batch)
+            return lines + [progress(entry, "error", error=f"Could not store document: {str(e)}") for entry, _ in batch]
+        await update_corpus_stats(db, sum(chunks for chunks, _ in stats_changes), sum(terms for _, terms in stats_changes))
+        counts["stored"] += len(batch)
+        metrics.inc("uploads.bulk_documents", len(batch))
+        return lines + [progress(entry, "stored", document_id=document.id) for entry, document in batch]
+
+    async with AsyncSessionLocal() as db:
+        existing_content = await find_hashes(db, Document.content_hash, {entry["content_hash"] for entry in entries if "content_hash" in entry})
+        tasks = [asyncio.create_task(extract(entry)) for entry in entries]
+        try:
+            batch = []
+            for next_result in asyncio.as_completed(tasks):
+                entry, text, error = await next_result
+                if error is not None:
+                    counts["errors"] += 1
+                    yield progress(entry, "error", error=error)
+                    continue
+                if text is None:
+                    yield duplicate(entry, existing_content.get(entry["content_hash"]), seen_content.get(entry["content_hash"]))
+                    continue
+
+                # Identical files extracted concurrently, only the first to succeed is kept
+                if entry["content_hash"] in seen_content:
+                    yield duplicate(entry, None, seen_content[entry["content_hash"]])
+                    continue
+                document_text_hash = text_hash(text)
+                if document_text_hash in seen_text:
+                    yield duplicate(entry, None, seen_text[document_text_hash])
+                    continue
+                seen_content[entry["content_hash"]] = entry["filename"]
+                seen_text[document_text_hash] = entry["filename"]
+
+                batch.append((entry, Document(
+                    date=datetime.now().date(),
+                    content=text,
+                    document_filename=entry["filename"],
+                    tags=common_tags + file_tags.get(entry["filename"], []),
+                    content_hash=entry["content_hash"],
+                    text_hash=document_text_hash,
+                )))
+                yield progress(entry, "extracted")
+                if len(batch) >= BULK_INSERT_BATCH:
+                    for line in await store(db, batch):
+                        yield line
+                    batch = []
+            if batch:
+                for line in await store(db, batch):
+                    yield line
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    seconds = time.perf_counter() - started
+    metrics.observe("uploads.bulk_seconds", seconds)
+    logger.info(f"Bulk upload stored {counts['stored']} of {total} files ({counts['duplicates']} duplicates) in {seconds:.2f}s")
+    yield json.dumps({
+        "status": "complete",
+        "total": total,
+        **counts,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(total / seconds, 2) if seconds else None,
+    }) + "\n"
+
+async def find_hashes(db: AsyncSession, column, hashes: Set[str]) -> Dict[str, int]:
+    """Maps each hash already stored in `column` to the id of the oldest document with it."""
+    if not hashes:
+        return {}
+    rows = (await db.execute(
+        select(column, func.min(Document.id)).where(column.in_(hashes)).group_by(column)
+    )).all()
+    return {value: document_id for value, document_id in rows}
+
+def parse_tags(tags: str) -> List[Dict]:
+    try:
+        return validate_tags(json.loads(tags))
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format for tags")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def parse_file_tags(file_tags: str) -> Dict[str, List[Dict]]:
+    # JSON object of filename (or archive member path) -> extra tags
+    try:
+        per_file = json.loads(file_tags)
+        if not isinstance(per_file, dict):
+            raise ValueError("File tags must be an object keyed by filename")
+        return {filename: validate_tags(file_tag_list) for filename, file_tag_list in per_file.items()}
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format for file tags")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-# Helper function to extract text from PDF
-def extract_text_from_pdf(content):
-    pdf = PdfReader(BytesIO(content))
-    text = ""
-    for page in pdf.pages:
-        text += page.extract_text(extraction_mode="layout")
-    return text
+def validate_tags(parsed_tags) -> List[Dict]:
+    if not isinstance(parsed_tags, list):
+        raise ValueError("Tags must be a list")
+    for tag in parsed_tags:
+        if not isinstance(tag, dict) or 'key' not in tag or 'value' not in tag:
+            raise ValueError("Each tag must be a dictionary with 'key' and 'value'")
+    return parsed_tags
 
 @router.delete("/{document_id}")
 def delete_document(
@@ -139,8 +331,13 @@ def delete_document(
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
+    chunk_count, total_terms = db.execute(chunk_totals_query([document.id])).one()
     db.delete(document)
     db.commit()
+    if chunk_count:
+        # Separately from the delete, every upload updates the same stats row
+        db.execute(corpus_stats_statement(-chunk_count, -total_terms))
+        db.commit()
     
     return {"message": "Document deleted successfully"}
 
@@ -157,6 +354,8 @@ def update_document_tags(
         raise HTTPException(status_code=404, detail="Document not found")
     
     document.tags = tags
+    for statement in replace_tags_statements([document]):
+        db.execute(statement)
     db.commit()
     db.refresh(document)
     
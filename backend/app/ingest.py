@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+from contextlib import asynccontextmanager
+from typing import IO, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import magic
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from .metrics import metrics
+from .pdf_extraction import extract_text_from_pdf
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+# libmagic only needs the start of a file to identify it
+UPLOAD_SNIFF_BYTES = int(os.getenv("UPLOAD_SNIFF_BYTES", "8192"))
+# Uploads past this many wait for a slot before being spooled and extracted
+UPLOAD_MAX_CONCURRENT = int(os.getenv("UPLOAD_MAX_CONCURRENT", "4"))
+# Files (including archive members) accepted by one bulk upload
+BULK_UPLOAD_MAX_FILES = int(os.getenv("BULK_UPLOAD_MAX_FILES", "5000"))
+BULK_UPLOAD_MAX_BYTES = int(os.getenv("BULK_UPLOAD_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Room for the form fields and multipart framing around the files
+UPLOAD_FORM_OVERHEAD_BYTES = int(os.getenv("UPLOAD_FORM_OVERHEAD_BYTES", str(1024 * 1024)))
+
+ARCHIVE_MIME_TYPES = {"application/zip", "application/x-tar", "application/gzip", "application/x-gzip", "application/x-bzip2", "application/x-xz"}
+
+# Opening a magic database is slow and a handle is not safe to share between threads unlocked
+_magic = magic.Magic(mime=True)
+_magic_lock = threading.Lock()
+
+upload_slots = asyncio.Semaphore(UPLOAD_MAX_CONCURRENT)
+_waiting = 0
+
+metrics.gauge("uploads.waiting", lambda: _waiting)
+
+
+class ArchiveTooLarge(Exception):
+    pass
+
+
+def sniff_mime(head: bytes) -> str:
+    with _magic_lock:
+        return _magic.from_buffer(head)
+
+
+@asynccontextmanager
+async def upload_slot():
+    global _waiting
+    _waiting += 1
+    try:
+        await upload_slots.acquire()
+    finally:
+        _waiting -= 1
+    try:
+        yield
+    finally:
+        upload_slots.release()
+
+
+class MultipartSpool:
+    """Parses a multipart/form-data body as it arrives, writing each file part straight to `directory`.
+
+    Files are hashed and sniffed on the way through, so nothing is read back
+    or copied once the body ends. Parser callbacks only buffer; `write` does
+    the disk writes off the event loop.
+    """
+
+    def __init__(self, boundary: bytes, charset: str, directory: str, max_file_bytes: int, max_files: int):
+        self.charset = charset
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.fields: Dict[str, str] = {}
+        self.files: List[Dict] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._part: Optional[Dict] = None
+        self._field_bytes = 0
+        # (open file, data) pairs waiting to be written, None data closes the file
+        self._pending: List[Tuple[IO[bytes], Optional[bytes]]] = []
+        self._open: List[IO[bytes]] = []
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    async def write(self, chunk: bytes):
+        self.parser.write(chunk)
+        if self._pending:
+            pending, self._pending = self._pending, []
+            await asyncio.to_thread(self._drain, pending)
+
+    async def finish(self):
+        self.parser.finalize()
+        if self._part is not None:
+            raise HTTPException(status_code=400, detail="Upload ended in the middle of a file")
+        if self._pending:
+            pending, self._pending = self._pending, []
+            await asyncio.to_thread(self._drain, pending)
+
+    def close(self):
+        for out in self._open:
+            out.close()
+        self._open = []
+
+    def _drain(self, pending: List[Tuple[IO[bytes], Optional[bytes]]]):
+        for out, data in pending:
+            if data is None:
+                out.close()
+            else:
+                out.write(data)
+
+    def _decode(self, value: bytes) -> str:
+        return value.decode(self.charset, errors="replace")
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._part = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = self._decode(options.get(b"name", b""))
+        if b"filename" not in options:
+            self._part = {"name": name, "value": bytearray()}
+            return
+
+        if len(self.files) >= self.max_files:
+            raise HTTPException(status_code=413, detail=f"Uploads are limited to {self.max_files} files")
+        path = os.path.join(self.directory, str(len(self.files)))
+        out = open(path, "wb")
+        self._open.append(out)
+        self._part = {
+            "filename": self._decode(options[b"filename"]),
+            "path": path,
+            "out": out,
+            "size": 0,
+            "head": b"",
+            "digest": hashlib.sha256(),
+        }
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        part = self._part
+        if "value" in part:
+            self._field_bytes += len(chunk)
+            if self._field_bytes > UPLOAD_FORM_OVERHEAD_BYTES:
+                raise HTTPException(status_code=413, detail="Upload form fields are too large")
+            part["value"] += chunk
+            return
+
+        part["size"] += len(chunk)
+        if part["size"] > self.max_file_bytes:
+            raise HTTPException(status_code=413, detail=f"File exceeds the {self.max_file_bytes} byte upload limit")
+        part["digest"].update(chunk)
+        if len(part["head"]) < UPLOAD_SNIFF_BYTES:
+            part["head"] += chunk[:UPLOAD_SNIFF_BYTES - len(part["head"])]
+        self._pending.append((part["out"], chunk))
+
+    def _on_part_end(self):
+        part, self._part = self._part, None
+        if "value" in part:
+            self.fields[part["name"]] = self._decode(bytes(part["value"]))
+            return
+
+        self._pending.append((part["out"], None))
+        self._open.remove(part["out"])
+        self.files.append({
+            "filename": part["filename"],
+            "path": part["path"],
+            "size": part["size"],
+            "mime": sniff_mime(part["head"]),
+            "content_hash": part["digest"].hexdigest(),
+        })
+
+
+async def spool_multipart(request: Request, directory: str, max_file_bytes: int, max_total_bytes: int, max_files: int) -> Tuple[Dict[str, str], List[Dict]]:
+    """Streams a multipart upload into `directory`, returning its form fields and one entry per file.
+
+    The size limits are enforced while the body arrives, before anything past
+    them is read, rather than after the whole request has been spooled.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    limit = max_total_bytes + UPLOAD_FORM_OVERHEAD_BYTES
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > limit:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the {max_total_bytes} byte limit")
+
+    charset = options.get(b"charset", b"utf-8").decode("latin-1")
+    spool = MultipartSpool(options[b"boundary"], charset, directory, max_file_bytes, max_files)
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds the {max_total_bytes} byte limit")
+            await spool.write(chunk)
+        await spool.finish()
+    finally:
+        spool.close()
+
+    metrics.inc("uploads.bytes", sum(upload["size"] for upload in spool.files))
+    return spool.fields, spool.files
+
+
+@asynccontextmanager
+async def spool_upload(request: Request, max_bytes: int = UPLOAD_MAX_BYTES) -> AsyncIterator[Tuple[Dict[str, str], Dict]]:
+    """Streams a single-file upload to a temporary file, yielding the form fields and the file's path, size and MIME type.
+
+    Only the first UPLOAD_SNIFF_BYTES are kept in memory for type detection.
+    The file is removed when the context exits.
+    """
+    directory = tempfile.mkdtemp(prefix="upload-")
+    try:
+        fields, uploads = await spool_multipart(request, directory, max_bytes, max_bytes, 1)
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+        yield fields, uploads[0]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def spool_bulk_upload(request: Request, directory: str) -> Tuple[Dict[str, str], List[Dict]]:
+    """Streams every uploaded file into `directory`, expanding zip and tar archives into their members.
+
+    Returns the form fields, and one entry per file with its filename, spooled
+    path and MIME type, or an `error` for members that could not be unpacked.
+    """
+    fields, uploads = await spool_multipart(request, directory, UPLOAD_MAX_BYTES, BULK_UPLOAD_MAX_BYTES, BULK_UPLOAD_MAX_FILES)
+    entries, total_bytes = [], sum(upload["size"] for upload in uploads)
+    for index, upload in enumerate(uploads):
+        if upload["mime"] in ARCHIVE_MIME_TYPES:
+            path = upload["path"]
+            # The other uploads still count towards the file limit
+            max_files = BULK_UPLOAD_MAX_FILES - len(entries) - (len(uploads) - index - 1)
+            members = await asyncio.to_thread(expand_archive, path, f"{path}-", max_files, BULK_UPLOAD_MAX_BYTES - total_bytes)
+            os.unlink(path)
+            total_bytes += sum(member.get("size", 0) for member in members)
+            entries.extend(members)
+        else:
+            entries.append(upload)
+
+        if len(entries) > BULK_UPLOAD_MAX_FILES:
+            raise HTTPException(status_code=413, detail=f"Bulk uploads are limited to {BULK_UPLOAD_MAX_FILES} files")
+    return fields, entries
+
+
+def expand_archive(path: str, prefix: str, max_files: int, max_bytes: int) -> List[Dict]:
+    # Members are copied out one by one, their names are never used as paths
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            members = [(info.filename, lambda info=info: archive.open(info)) for info in archive.infolist() if not info.is_dir()]
+            return copy_members(members, prefix, max_files, max_bytes)
+    try:
+        with tarfile.open(path, "r:*") as archive:
+            members = [(info.name, lambda info=info: archive.extractfile(info)) for info in archive.getmembers() if info.isfile()]
+            return copy_members(members, prefix, max_files, max_bytes)
+    except tarfile.TarError as e:
+        raise HTTPException(status_code=400, detail=f"Could not read archive: {str(e)}")
+
+
+def copy_members(members: List[Tuple[str, Callable[[], IO[bytes]]]], prefix: str, max_files: int, max_bytes: int) -> List[Dict]:
+    """Copies archive members out, stopping the whole upload once their decompressed total passes `max_bytes`."""
+    if len(members) > max_files:
+        raise HTTPException(status_code=413, detail=f"Bulk uploads are limited to {BULK_UPLOAD_MAX_FILES} files")
+
+    entries, total_bytes = [], 0
+    for index, (filename, open_member) in enumerate(members):
+        path = f"{prefix}{index}"
+        try:
+            size, head, digest = 0, b"", hashlib.sha256()
+            with open_member() as source, open(path, "wb") as out:
+                while chunk := source.read(UPLOAD_CHUNK_BYTES):
+                    size += len(chunk)
+                    total_bytes += len(chunk)
+                    if total_bytes > max_bytes:
+                        raise ArchiveTooLarge()
+                    digest.update(chunk)
+                    if size > UPLOAD_MAX_BYTES:
+                        raise ValueError(f"File exceeds the {UPLOAD_MAX_BYTES} byte upload limit")
+                    if len(head) < UPLOAD_SNIFF_BYTES:
+                        head += chunk[:UPLOAD_SNIFF_BYTES - len(head)]
+                    out.write(chunk)
+            entries.append({"filename": filename, "path": path, "size": size, "mime": sniff_mime(head), "content_hash": digest.hexdigest()})
+        except ArchiveTooLarge:
+            raise HTTPException(status_code=413, detail=f"Archive contents exceed the {BULK_UPLOAD_MAX_BYTES} byte bulk upload limit")
+        except Exception as e:
+            entries.append({"filename": filename, "error": str(e)})
+    return entries
+
+
+def text_hash(text: str) -> str:
+    # Whitespace is normalized so the same transcript extracted slightly differently still matches
+    return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+
+
+def read_text_file(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+async def extract_text(path: str, mime: str) -> Tuple[str, Optional[Dict]]:
+    """Returns the text of a spooled file, plus PDF extraction details for PDFs."""
+    if mime == "application/pdf":
+        try:
+            extraction = await extract_text_from_pdf(path)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return extraction["text"], extraction
+    if mime.startswith("text/"):
+        try:
+            return await asyncio.to_thread(read_text_file, path), None
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="Text files must be UTF-8 encoded")
+    raise HTTPException(status_code=400, detail="Unsupported file type")
@@ -0,0 +1,360 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import socket
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import SQLALCHEMY_DATABASE_URL, AsyncSessionLocal
+from .metrics import metrics
+from .models import AnalysisJob
+from .scheduler import current_job_size, current_user_id
+
+logger = logging.getLogger(__name__)
+
+# inline runs analysis in the web process, queue hands it to `python worker.py` processes
+ANALYSIS_EXECUTION = os.getenv("ANALYSIS_EXECUTION", "inline")
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "16"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# A running job whose worker has not checked in for this long is handed to another worker
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_EVENT_MAX_BYTES = 7000
+
+JOBS_CHANNEL = "analysis_jobs"
+JOB_EVENTS_CHANNEL = "analysis_job_events"
+
+JobHandler = Callable[[Dict, str, int, Callable[[str], Awaitable[None]]], Awaitable[tuple[str, list[dict]]]]
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETE = "complete"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+
+def serialize_document(document: Dict) -> Dict:
+    return {**document, "document_date": document["document_date"].isoformat()}
+
+
+def deserialize_document(data: Dict) -> Dict:
+    return {**data, "document_date": datetime.date.fromisoformat(data["document_date"])}
+
+
+async def notify(db: AsyncSession, channel: str, payload: str):
+    # Delivered when the surrounding transaction commits
+    await db.execute(select(func.pg_notify(channel, payload)))
+
+
+async def publish_job_event(job_id: int, **event):
+    payload = json.dumps({"job_id": job_id, **event})
+    if len(payload.encode()) > JOB_EVENT_MAX_BYTES:
+        # Progress frames are best effort, the result itself is read from the job row
+        metrics.inc("jobs.dropped_events")
+        return
+    async with AsyncSessionLocal() as db:
+        await notify(db, JOB_EVENTS_CHANNEL, payload)
+        await db.commit()
+
+
+class JobEvents:
+    """Relays progress events from job workers to the process waiting on each job."""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._watchers: Dict[int, asyncio.Queue] = {}
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def watch(self, job_id: int) -> asyncio.Queue:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+        events = self._watchers.setdefault(job_id, asyncio.Queue())
+        try:
+            await asyncio.wait_for(self._connected.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            # Completion is still picked up by polling the job row
+            logger.warning("Job event listener is not connected yet")
+        return events
+
+    def unwatch(self, job_id: int):
+        self._watchers.pop(job_id, None)
+
+    async def _listen(self):
+        while True:
+            terminated = asyncio.Event()
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                connection.add_termination_listener(lambda connection: terminated.set())
+                await connection.add_listener(JOB_EVENTS_CHANNEL, self._on_notification)
+                self._connected.set()
+                await terminated.wait()
+                logger.warning("Job event listener connection lost, reconnecting")
+            except (asyncpg.PostgresError, OSError) as e:
+                logger.error(f"Job event listener failed: {str(e)}")
+            self._connected.clear()
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        event = json.loads(payload)
+        events = self._watchers.get(event["job_id"])
+        if events is not None:
+            events.put_nowait(event)
+
+
+job_events = JobEvents(SQLALCHEMY_DATABASE_URL)
+
+
+async def run_analysis_job(document: Dict, user_question: str, conversation_id: int, send: Callable[[str], Awaitable[None]]) -> tuple[str, list[dict]]:
+    """Queue one document for a job worker and wait for its result, relaying progress frames to `send`."""
+    async with AsyncSessionLocal() as db:
+        job = AnalysisJob(
+            conversation_id=conversation_id,
+            document_id=document["document_id"],
+            user_id=current_user_id.get(),
+            job_size=current_job_size.get(),
+            user_question=user_question,
+            document=serialize_document(document),
+            status=JobStatus.QUEUED.value,
+            attempts=0,
+        )
+        db.add(job)
+        await db.flush()
+        job_id = job.id
+        events = await job_events.watch(job_id)
+        await notify(db, JOBS_CHANNEL, str(job_id))
+        await db.commit()
+    metrics.inc("jobs.enqueued")
+
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                event = None
+            if event is not None and "frame" in event:
+                await send(event["frame"])
+                continue
+
+            async with AsyncSessionLocal() as db:
+                job = (await db.execute(select(AnalysisJob).where(AnalysisJob.id == job_id))).scalars().first()
+            if job is None or job.status == JobStatus.CANCELLED.value:
+                raise RuntimeError(f"Analysis job {job_id} was cancelled")
+            if job.status == JobStatus.COMPLETE.value:
+                return job.result, job.citations
+            if job.status == JobStatus.ERROR.value:
+                raise RuntimeError(job.error or f"Analysis job {job_id} failed")
+    except asyncio.CancelledError:
+        await cancel_job(job_id)
+        raise
+    finally:
+        job_events.unwatch(job_id)
+
+
+async def cancel_job(job_id: int):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(AnalysisJob)
+            .where(AnalysisJob.id == job_id, AnalysisJob.status.in_([JobStatus.QUEUED.value, JobStatus.RUNNING.value]))
+            .values(status=JobStatus.CANCELLED.value, finished_at=datetime.datetime.utcnow())
+        )
+        await db.commit()
+    metrics.inc("jobs.cancelled")
+
+
+class JobWorker:
+    """Claims queued analysis jobs with SKIP LOCKED and runs up to `concurrency` at once.
+
+    Running jobs are kept alive with a heartbeat. Jobs whose worker stops
+    heartbeating are requeued, up to `max_attempts`, and jobs cancelled or
+    reclaimed elsewhere are stopped at the next heartbeat.
+    """
+
+    def __init__(self, handler: JobHandler, concurrency: int, lease_seconds: float, poll_seconds: float, max_attempts: int):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._running: Dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._connection: Optional[asyncpg.Connection] = None
+
+        metrics.gauge("jobs.running", lambda: len(self._running))
+
+    async def run(self):
+        logger.info(f"Analysis worker {self.worker_id} started with concurrency {self.concurrency}")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while True:
+                await self._ensure_listening()
+                await self._requeue_expired()
+
+                free = self.concurrency - len(self._running)
+                claimed = await self._claim(free) if free > 0 else []
+                for job in claimed:
+                    task = asyncio.create_task(self._run_job(job))
+                    self._running[job.id] = task
+                    task.add_done_callback(lambda task, job_id=job.id: self._on_job_done(job_id))
+                if claimed and len(claimed) == free:
+                    # There may be more waiting once a slot frees up
+                    continue
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            heartbeat.cancel()
+            for task in self._running.values():
+                task.cancel()
+            if self._connection is not None and not self._connection.is_closed():
+                await self._connection.close()
+
+    async def _ensure_listening(self):
+        if self._connection is not None and not self._connection.is_closed():
+            return
+        try:
+            self._connection = await asyncpg.connect(SQLALCHEMY_DATABASE_URL)
+            await self._connection.add_listener(JOBS_CHANNEL, lambda *args: self._wakeup.set())
+        except (asyncpg.PostgresError, OSError) as e:
+            # Polling still finds new jobs, just more slowly
+            logger.error(f"Could not listen for new jobs: {str(e)}")
+
+    def _on_job_done(self, job_id: int):
+        self._running.pop(job_id, None)
+        self._wakeup.set()
+
+    async def _claim(self, limit: int) -> List[AnalysisJob]:
+        now = datetime.datetime.utcnow()
+        candidates = (
+            select(AnalysisJob.id)
+            .where(AnalysisJob.status == JobStatus.QUEUED.value)
+            .order_by(AnalysisJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        async with AsyncSessionLocal() as db:
+            jobs = (await db.execute(
+                update(AnalysisJob)
+                .where(AnalysisJob.id.in_(candidates.scalar_subquery()))
+                .values(
+                    status=JobStatus.RUNNING.value,
+                    attempts=AnalysisJob.attempts + 1,
+                    locked_by=self.worker_id,
+                    heartbeat_at=now,
+                )
+                .returning(AnalysisJob)
+                .execution_options(synchronize_session=False)
+            )).scalars().all()
+            await db.commit()
+
+        if jobs:
+            metrics.inc("jobs.claimed", len(jobs))
+            logger.info(f"Claimed {len(jobs)} analysis jobs")
+        return list(jobs)
+
+    async def _requeue_expired(self):
+        expired = datetime.datetime.utcnow() - self.lease
+        stale = (AnalysisJob.status == JobStatus.RUNNING.value, AnalysisJob.heartbeat_at < expired)
+        async with AsyncSessionLocal() as db:
+            requeued = await db.execute(
+                update(AnalysisJob)
+                .where(*stale, AnalysisJob.attempts < self.max_attempts)
+                .values(status=JobStatus.QUEUED.value, locked_by=None)
+            )
+            failed = await db.execute(
+                update(AnalysisJob)
+                .where(*stale, AnalysisJob.attempts >= self.max_attempts)
+                .values(
+                    status=JobStatus.ERROR.value,
+                    error=f"Abandoned by workers {self.max_attempts} times",
+                    finished_at=datetime.datetime.utcnow(),
+                )
+            )
+            await db.commit()
+
+        if requeued.rowcount or failed.rowcount:
+            metrics.inc("jobs.requeued", requeued.rowcount)
+            metrics.inc("jobs.abandoned", failed.rowcount)
+            logger.warning(f"Requeued {requeued.rowcount} and failed {failed.rowcount} jobs from lost workers")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            job_ids = list(self._running)
+            if not job_ids:
+                continue
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(AnalysisJob)
+                        .where(AnalysisJob.id.in_(job_ids), AnalysisJob.locked_by == self.worker_id)
+                        .values(heartbeat_at=datetime.datetime.utcnow())
+                    )
+                    lost = (await db.execute(
+                        select(AnalysisJob.id).where(
+                            AnalysisJob.id.in_(job_ids),
+                            or_(AnalysisJob.status != JobStatus.RUNNING.value, AnalysisJob.locked_by != self.worker_id),
+                        )
+                    )).scalars().all()
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Job heartbeat failed: {str(e)}")
+                continue
+
+            # Cancelled by the requester or reclaimed after a missed lease
+            for job_id in lost:
+                task = self._running.get(job_id)
+                if task:
+                    task.cancel()
+
+    async def _run_job(self, job: AnalysisJob):
+        async def send(frame: str):
+            await publish_job_event(job.id, frame=frame)
+
+        # Calls made for this job are scheduled as the requesting user's
+        current_user_id.set(job.user_id)
+        current_job_size.set(job.job_size or 1)
+        try:
+            result, citations = await self.handler(deserialize_document(job.document), job.user_question, job.conversation_id, send)
+        except asyncio.CancelledError:
+            logger.info(f"Analysis job {job.id} stopped")
+            raise
+        except Exception as e:
+            logger.error(f"Analysis job {job.id} failed: {str(e)}")
+            metrics.inc("jobs.failed")
+            await self._finish(job.id, status=JobStatus.ERROR.value, error=str(e))
+        else:
+            metrics.inc("jobs.completed")
+            await self._finish(job.id, status=JobStatus.COMPLETE.value, result=result, citations=citations)
+        await publish_job_event(job.id, done=True)
+
+    async def _finish(self, job_id: int, **values):
+        async with AsyncSessionLocal() as db:
+            # A job cancelled or reclaimed in the meantime keeps its newer state
+            await db.execute(
+                update(AnalysisJob)
+                .where(
+                    AnalysisJob.id == job_id,
+                    AnalysisJob.status == JobStatus.RUNNING.value,
+                    AnalysisJob.locked_by == self.worker_id,
+                )
+                .values(finished_at=datetime.datetime.utcnow(), **values)
+            )
+            await db.commit()
+
+
+async def run_worker(handler: JobHandler):
+    worker = JobWorker(handler, JOB_WORKER_CONCURRENCY, JOB_LEASE_SECONDS, JOB_POLL_SECONDS, JOB_MAX_ATTEMPTS)
+    await worker.run()
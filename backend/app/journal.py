@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert
+
+from .database import AsyncSessionLocal
+from .metrics import metrics
+from .models import WebSocketMessage
+
+logger = logging.getLogger(__name__)
+
+WS_JOURNAL_MAX_QUEUE = int(os.getenv("WS_JOURNAL_MAX_QUEUE", "10000"))
+WS_JOURNAL_BATCH_SIZE = int(os.getenv("WS_JOURNAL_BATCH_SIZE", "500"))
+WS_JOURNAL_FLUSH_INTERVAL = float(os.getenv("WS_JOURNAL_FLUSH_INTERVAL", "0.5"))
+
+
+class WebSocketJournal:
+    """Write-behind persistence for websocket frames.
+
+    Frames are queued in memory and written to `websocket_messages` by a
+    background task in multi-row inserts, once `batch_size` rows are waiting
+    or `flush_interval` seconds have passed since the first queued row.
+    """
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._has_rows = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        metrics.gauge("ws_journal.queue_depth", self.queue.qsize)
+
+    async def record(self, conversation_id: str, message_type: str, content: str, seq: Optional[int] = None):
+        self._ensure_started()
+
+        if self.queue.full():
+            metrics.inc("ws_journal.queue_full")
+        await self.queue.put({
+            "conversation_id": conversation_id,
+            "message_type": message_type,
+            "content": content,
+            "seq": seq,
+            "timestamp": datetime.datetime.utcnow(),
+        })
+        self._has_rows.set()
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        async with self._write_lock:
+            while not self.queue.empty():
+                await self._write(self._take_batch())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_rows.wait()
+            if self.queue.qsize() < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            async with self._write_lock:
+                await self._write(self._take_batch())
+
+    def _take_batch(self) -> List[Dict]:
+        rows = self._drain(self.batch_size)
+        if self.queue.qsize() < self.batch_size:
+            self._batch_ready.clear()
+        if self.queue.empty():
+            self._has_rows.clear()
+        return rows
+
+    def _drain(self, limit: int) -> List[Dict]:
+        rows = []
+        while len(rows) < limit and not self.queue.empty():
+            rows.append(self.queue.get_nowait())
+            self.queue.task_done()
+        return rows
+
+    async def _write(self, rows: List[Dict]):
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            await self._insert(rows)
+            metrics.inc("ws_journal.rows_written", len(rows))
+        except Exception as e:
+            # One bad row (e.g. a conversation deleted since) shouldn't lose everyone else's frames
+            logger.warning(f"Failed to persist {len(rows)} websocket messages, retrying per conversation: {str(e)}")
+            metrics.inc("ws_journal.batch_retries")
+            await self._write_separately(rows)
+        finally:
+            metrics.observe("ws_journal.flush_latency", time.perf_counter() - start)
+
+    async def _write_separately(self, rows: List[Dict]):
+        by_conversation: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_conversation.setdefault(row["conversation_id"], []).append(row)
+
+        for conversation_id, conversation_rows in by_conversation.items():
+            try:
+                await self._insert(conversation_rows)
+                metrics.inc("ws_journal.rows_written", len(conversation_rows))
+                continue
+            except Exception:
+                pass
+            for row in conversation_rows:
+                try:
+                    await self._insert([row])
+                    metrics.inc("ws_journal.rows_written")
+                except Exception as e:
+                    metrics.inc("ws_journal.rows_dropped")
+                    logger.error(f"Failed to persist websocket message for conversation {conversation_id}: {str(e)}")
+
+    async def _insert(self, rows: List[Dict]):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(WebSocketMessage), rows)
+            await db.commit()
+
+
+websocket_journal = WebSocketJournal(WS_JOURNAL_MAX_QUEUE, WS_JOURNAL_BATCH_SIZE, WS_JOURNAL_FLUSH_INTERVAL)
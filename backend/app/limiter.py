@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+import openai
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "32"))
+ANALYSIS_INITIAL_CONCURRENCY = int(os.getenv("ANALYSIS_INITIAL_CONCURRENCY", "8"))
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+# A request whose time to first token exceeds this multiple of the running average counts as a latency spike
+ANALYSIS_LATENCY_SPIKE_FACTOR = float(os.getenv("ANALYSIS_LATENCY_SPIKE_FACTOR", "3"))
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # Requests larger than the whole bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class CallTimer:
+    """Handed to the caller so it can mark when the first token of the response arrived."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first_token_latency = None
+
+    def first_token(self):
+        if self.first_token_latency is None:
+            self.first_token_latency = time.monotonic() - self.start
+
+
+class AdaptiveLimiter:
+    """Concurrency limiter for outbound LLM calls.
+
+    Admission needs a free concurrency slot plus room in the requests- and
+    tokens-per-minute buckets. The concurrency limit itself follows AIMD: it
+    grows by roughly one slot per round of successful calls and halves on a
+    429 or a latency spike, never exceeding `max_concurrency`. Latency is time
+    to first token, which unlike total time doesn't grow with the size of the
+    window or the length of the streamed answer.
+    """
+
+    def __init__(self, max_concurrency: int, initial_concurrency: int, rpm: int, tpm: int, latency_spike_factor: float):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max(1, min(initial_concurrency, max_concurrency)))
+        self.latency_spike_factor = latency_spike_factor
+        self.in_flight = 0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.average_latency = None
+        self._last_decrease = 0.0
+        self._released = asyncio.Event()
+
+        metrics.gauge("analysis_limiter.in_flight", lambda: self.in_flight)
+        metrics.gauge("analysis_limiter.limit", lambda: int(self.limit))
+
+    @asynccontextmanager
+    async def running(self):
+        """Track a call that was already admitted, releasing its slot when it ends."""
+        timer = CallTimer()
+        try:
+            yield timer
+        except openai.RateLimitError:
+            metrics.inc("analysis_limiter.rate_limited")
+            self._decrease("rate limited")
+            raise
+        else:
+            # A response with no tokens at all is as slow as its first token would have been
+            timer.first_token()
+            metrics.observe("analysis_limiter.time_to_first_token", timer.first_token_latency)
+            self._record_latency(timer.first_token_latency)
+        finally:
+            self.release()
+
+    def release(self):
+        self.in_flight -= 1
+        self._released.set()
+
+    async def admit(self, estimated_tokens: int) -> float:
+        start = time.monotonic()
+        while True:
+            wait = None
+            if self.in_flight < int(self.limit):
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    self.in_flight += 1
+                    return time.monotonic() - start
+
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _record_latency(self, latency: float):
+        if self.average_latency is not None and latency > self.average_latency * self.latency_spike_factor:
+            metrics.inc("analysis_limiter.latency_spikes")
+            self._decrease(f"latency spike ({latency:.1f}s)")
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+        if self.average_latency is None:
+            self.average_latency = latency
+        else:
+            self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        # Responses from the same congested window should only back off once
+        if now - self._last_decrease < (self.average_latency or 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(1.0, self.limit / 2)
+        logger.warning(f"Backing off analysis concurrency to {int(self.limit)}: {reason}")
+
+
+analysis_limiter = AdaptiveLimiter(
+    ANALYSIS_MAX_CONCURRENCY,
+    ANALYSIS_INITIAL_CONCURRENCY,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    ANALYSIS_LATENCY_SPIKE_FACTOR,
+)
@@ -1,8 +1,13 @@
-from fastapi import APIRouter, FastAPI
+from fastapi import APIRouter, Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from .backplane import backplane
+from .chat import chat_manager, get_current_user, handle_control, websocket_manager
 from .chat import router as chat_router
 from .documents import router as document_router
+from .journal import websocket_journal
+from .metrics import router as metrics_router
+from .pdf_extraction import shutdown_executor
 
 app = FastAPI()
 
@@ -24,9 +29,23 @@ api_router.include_router(document_router, prefix="/documents", tags=["Documents
 
 # Include the new user-related endpoints
 api_router.include_router(chat_router, prefix="/users", tags=["Users"])
+# Metrics name internal counters and user ids, so they need a logged in user like everything else
+api_router.include_router(metrics_router, prefix="/metrics", tags=["Metrics"], dependencies=[Depends(get_current_user)])
 
 # Include the api_router in the main app
 app.include_router(api_router)
 
+@app.on_event("startup")
+async def startup():
+    # Frames published by other workers are delivered to this worker's sockets
+    await backplane.start(websocket_manager.deliver, chat_manager.invalidate, handle_control)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await backplane.close()
+    # Drain any websocket messages still waiting to be persisted
+    await websocket_journal.close()
+    shutdown_executor()
+
 # Optionally, remove or comment out the direct inclusion of financial_data_router
 # app.include_router(financial_data_router)
\ No newline at end of file
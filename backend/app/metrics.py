@@ -0,0 +1,51 @@
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+from fastapi import APIRouter
+
+router = APIRouter()
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        # Gauges are read lazily so callers don't have to keep them up to date
+        self.gauges[name] = fn
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {
+                name: {**timing, "avg": timing["total"] / timing["count"] if timing["count"] else 0.0}
+                for name, timing in self.timings.items()
+            }
+        return {
+            "counters": counters,
+            "gauges": {name: fn() for name, fn in self.gauges.items()},
+            "timings": timings,
+        }
+
+
+metrics = Metrics()
+
+
+@router.get("/")
+async def get_metrics():
+    return metrics.snapshot()
@@ -3,10 +3,12 @@ import json
 
 from sqlalchemy import (
     JSON,
+    BigInteger,
     Column,
     Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
@@ -24,6 +26,8 @@ class Document(Base):
     content = Column(Text)
     document_filename = Column(String)
     tags = Column(JSON)
+    content_hash = Column(String(64), index=True)  # sha256 of the uploaded bytes
+    text_hash = Column(String(64), index=True)  # sha256 of the extracted text, whitespace normalized
 
     def to_dict(self):
         return {
@@ -34,6 +38,15 @@ class Document(Base):
             "tags": self.tags,
         }
 
+class DocumentTag(Base):
+    __tablename__ = "document_tags"
+    __table_args__ = (Index("ix_document_tags_key_value_document_id", "key", "value", "document_id"),)
+
+    # Normalized copy of Document.tags for filtering, kept in sync wherever tags are written
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+
 class Conversation(Base):
     __tablename__ = "conversations"
 
@@ -45,6 +58,7 @@ class Conversation(Base):
     websocket_messages = relationship("WebSocketMessage", back_populates="conversation")
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("User", back_populates="conversations")
+    frame_seq = Column(Integer, default=0, server_default="0", nullable=False)  # Last seq given to an outgoing websocket frame
 
     def to_dict(self):
         return {
@@ -57,6 +71,7 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (Index("ix_messages_conversation_id_created_at_id", "conversation_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"))
@@ -76,11 +91,13 @@ class Message(Base):
 
 class WebSocketMessage(Base):
     __tablename__ = "websocket_messages"
+    __table_args__ = (Index("ix_websocket_messages_conversation_id_seq", "conversation_id", "seq"),)
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"))
     message_type = Column(String)  # e.g., 'user', 'assistant', 'system', 'tool_call', etc.
     content = Column(Text)
+    seq = Column(Integer)  # Per-conversation order of outgoing frames, null for incoming ones
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     conversation = relationship("Conversation", back_populates="websocket_messages")
 
@@ -108,3 +125,70 @@ class User(Base):
             "username": self.username,
             "email": self.email,
         }
+
+class AnalysisCacheEntry(Base):
+    __tablename__ = "analysis_cache"
+
+    key = Column(String, primary_key=True)
+    model = Column(String)
+    prompt_version = Column(String)
+    response = Column(Text)
+    citations = Column(JSON)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    last_accessed_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+class DocumentChunk(Base):
+    __tablename__ = "document_chunks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), index=True)
+    chunk_index = Column(Integer)
+    content = Column(Text)
+    start_char = Column(Integer)
+    term_count = Column(Integer)
+
+class ChunkTerm(Base):
+    __tablename__ = "chunk_terms"
+    __table_args__ = (Index("ix_chunk_terms_document_id_term", "document_id", "term"),)
+
+    term = Column(String, primary_key=True)
+    chunk_id = Column(Integer, ForeignKey("document_chunks.id", ondelete="CASCADE"), primary_key=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"))
+    term_frequency = Column(Integer)
+
+class CorpusStats(Base):
+    # A single row of corpus-wide BM25 statistics, kept up to date as documents are indexed and deleted
+    __tablename__ = "corpus_stats"
+
+    id = Column(Integer, primary_key=True)
+    chunk_count = Column(BigInteger, default=0, server_default="0", nullable=False)
+    total_terms = Column(BigInteger, default=0, server_default="0", nullable=False)
+
+class BroadcastPayload(Base):
+    __tablename__ = "broadcast_payloads"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"))
+    content = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    __table_args__ = (Index("ix_analysis_jobs_status_id", "status", "id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"))
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    job_size = Column(Integer)  # Number of documents in the analysis this job belongs to
+    user_question = Column(Text)
+    document = Column(JSON)  # The document as prepared for analysis, possibly trimmed to relevant chunks
+    status = Column(String)  # queued, running, complete, error or cancelled
+    attempts = Column(Integer, default=0)
+    locked_by = Column(String)
+    result = Column(Text)
+    citations = Column(JSON)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Union
+
+from pypdf import PdfReader
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", str(os.cpu_count() or 2)))
+# Pages handled per pool task, large enough that reopening the PDF in each task stays cheap
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+
+# Raw PDF bytes, or the path of a file holding them
+PdfSource = Union[bytes, str]
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PDF_EXTRACTION_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def open_pdf(source: PdfSource) -> PdfReader:
+    return PdfReader(BytesIO(source) if isinstance(source, bytes) else source)
+
+
+def count_pages(source: PdfSource) -> int:
+    return len(open_pdf(source).pages)
+
+
+def extract_page_range(source: PdfSource, start: int, end: int) -> List[Dict]:
+    # Runs in a worker process, one failing page only loses that page
+    pdf = open_pdf(source)
+    pages = []
+    for index in range(start, end):
+        started = time.perf_counter()
+        try:
+            text, error = pdf.pages[index].extract_text(extraction_mode="layout"), None
+        except Exception as e:
+            text, error = "", f"{type(e).__name__}: {e}"
+        pages.append({"page": index + 1, "text": text, "seconds": time.perf_counter() - started, "error": error})
+    return pages
+
+
+async def extract_text_from_pdf(source: PdfSource) -> Dict:
+    """Extracts the text of every page in parallel worker processes.
+
+    Returns the joined text along with per-page timings and any page-level
+    errors. Raises ValueError if the PDF cannot be opened at all.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    started = time.perf_counter()
+
+    try:
+        page_count = await loop.run_in_executor(executor, count_pages, source)
+    except Exception as e:
+        raise ValueError(f"Could not read PDF: {str(e)}") from e
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    results = await asyncio.gather(
+        *[loop.run_in_executor(executor, extract_page_range, source, start, end) for start, end in ranges],
+        return_exceptions=True,
+    )
+
+    pages = []
+    for (start, end), result in zip(ranges, results):
+        if isinstance(result, BaseException):
+            # The whole task failed (e.g. the worker died), mark its pages instead of failing the upload
+            error = f"{type(result).__name__}: {result}"
+            pages.extend({"page": index + 1, "text": "", "seconds": 0.0, "error": error} for index in range(start, end))
+        else:
+            pages.extend(result)
+
+    page_errors = [{"page": page["page"], "error": page["error"]} for page in pages if page["error"]]
+    for page in pages:
+        metrics.observe("pdf.page_seconds", page["seconds"])
+    metrics.inc("pdf.pages", page_count)
+    metrics.inc("pdf.page_errors", len(page_errors))
+
+    seconds = time.perf_counter() - started
+    metrics.observe("pdf.extraction_seconds", seconds)
+    if page_errors:
+        logger.warning(f"Failed to extract {len(page_errors)} of {page_count} PDF pages: {page_errors[:5]}")
+    logger.info(f"Extracted {page_count} PDF pages in {seconds:.2f}s across {len(ranges)} tasks")
+
+    return {
+        "text": "".join(page["text"] for page in pages),
+        "pages": page_count,
+        "seconds": seconds,
+        "page_seconds": [round(page["seconds"], 4) for page in pages],
+        "page_errors": page_errors,
+    }
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import ChunkTerm, CorpusStats, Document, DocumentChunk
+from .pdf_extraction import get_executor
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+# Documents below this size are still analyzed whole
+RETRIEVAL_MIN_TOKENS = int(os.getenv("RETRIEVAL_MIN_TOKENS", "4000"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "has", "have",
+    "in", "is", "it", "its", "of", "on", "or", "that", "the", "their", "this", "to", "was",
+    "were", "what", "which", "will", "with",
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def chunk_text(text: str, max_tokens: int, overlap_tokens: int) -> List[Tuple[int, str]]:
+    """Split text into overlapping windows of roughly `max_tokens` tokens.
+
+    Windows end on a line break or space where possible. Returns
+    `(start_char, chunk)` pairs in document order.
+    """
+    size = max_tokens * 4
+    overlap = min(overlap_tokens * 4, size // 2)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            cut = text.rfind("\n", start + size // 2, end)
+            if cut == -1:
+                cut = text.rfind(" ", start + size // 2, end)
+            if cut != -1:
+                end = cut
+        chunks.append((start, text[start:end]))
+        if end >= len(text):
+            break
+
+        start = end - overlap
+        # Don't start the next window in the middle of a word
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return chunks
+
+
+def build_chunks(text: str) -> List[Tuple[int, str, Counter]]:
+    # Runs in a worker process, chunking and tokenizing a long filing would stall the event loop
+    return [(start_char, content, Counter(tokenize(content))) for start_char, content in chunk_text(text, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)]
+
+
+def chunk_totals_query(document_ids: List[int]):
+    return select(func.count(DocumentChunk.id), func.coalesce(func.sum(DocumentChunk.term_count), 0)).where(DocumentChunk.document_id.in_(document_ids))
+
+
+def corpus_stats_statement(chunk_count: int, total_terms: int):
+    """Adds a change to the corpus stats, run by sync or async sessions alike.
+
+    Every upload updates the same row, so run it in its own short transaction
+    after the chunks are committed rather than holding the row lock while they
+    are written. The row is created on first use in databases that didn't
+    come through the migration.
+    """
+    return (
+        postgresql.insert(CorpusStats)
+        .values(id=1, chunk_count=chunk_count, total_terms=total_terms)
+        .on_conflict_do_update(
+            index_elements=[CorpusStats.id],
+            set_={"chunk_count": CorpusStats.chunk_count + chunk_count, "total_terms": CorpusStats.total_terms + total_terms},
+        )
+    )
+
+
+async def update_corpus_stats(db: AsyncSession, chunk_count: int, total_terms: int):
+    if not chunk_count and not total_terms:
+        return
+    try:
+        await db.execute(corpus_stats_statement(chunk_count, total_terms))
+        await db.commit()
+    except SQLAlchemyError as e:
+        # The chunks are already stored, slightly stale stats only nudge BM25 scores
+        await db.rollback()
+        logger.error(f"Failed to update corpus stats: {str(e)}")
+
+
+async def index_document(db: AsyncSession, document: Document) -> Tuple[int, int]:
+    """Replaces the document's chunks and postings in the caller's transaction.
+
+    Returns the change in (chunks, terms), for the caller to pass to
+    `update_corpus_stats` once it has committed.
+    """
+    previous_chunks, previous_terms = (await db.execute(chunk_totals_query([document.id]))).one()
+    await db.execute(delete(DocumentChunk).where(DocumentChunk.document_id == document.id))
+
+    chunks = await asyncio.get_running_loop().run_in_executor(get_executor(), build_chunks, document.content or "")
+    chunk_rows = [
+        {
+            "document_id": document.id,
+            "chunk_index": chunk_index,
+            "content": content,
+            "start_char": start_char,
+            "term_count": sum(counts.values()),
+        }
+        for chunk_index, (start_char, content, counts) in enumerate(chunks)
+    ]
+    chunk_terms = [counts for _, _, counts in chunks]
+
+    if not chunk_rows:
+        return -previous_chunks, -previous_terms
+
+    chunk_ids = (await db.execute(insert(DocumentChunk).returning(DocumentChunk.id, sort_by_parameter_order=True), chunk_rows)).scalars().all()
+
+    term_rows = [
+        {"term": term, "chunk_id": chunk_id, "document_id": document.id, "term_frequency": frequency}
+        for chunk_id, counts in zip(chunk_ids, chunk_terms)
+        for term, frequency in counts.items()
+    ]
+    if term_rows:
+        await db.execute(insert(ChunkTerm), term_rows)
+
+    logger.info(f"Indexed document {document.id}: {len(chunk_rows)} chunks, {len(term_rows)} postings")
+    return len(chunk_rows) - previous_chunks, sum(row["term_count"] for row in chunk_rows) - previous_terms
+
+
+async def top_chunks(db: AsyncSession, document_ids: List[int], question: str, k: int) -> Dict[int, List[str]]:
+    """Return the `k` best BM25 chunks per document, in document order."""
+    terms = list(set(tokenize(question)))
+    if not terms or not document_ids:
+        return {}
+
+    # Kept up to date as documents are indexed rather than counted over every chunk on each question
+    stats = (await db.execute(select(CorpusStats.chunk_count, CorpusStats.total_terms))).first()
+    if stats is None or stats.chunk_count <= 0:
+        return {}
+    total_chunks = stats.chunk_count
+    average_length = stats.total_terms / total_chunks or 1
+
+    document_frequency = dict((await db.execute(
+        select(ChunkTerm.term, func.count())
+        .where(ChunkTerm.term.in_(terms))
+        .group_by(ChunkTerm.term)
+    )).all())
+
+    postings = (await db.execute(
+        select(ChunkTerm.document_id, ChunkTerm.chunk_id, ChunkTerm.term, ChunkTerm.term_frequency, DocumentChunk.term_count)
+        .join(DocumentChunk, DocumentChunk.id == ChunkTerm.chunk_id)
+        .where(ChunkTerm.document_id.in_(document_ids), ChunkTerm.term.in_(terms))
+    )).all()
+
+    scores: Dict[int, Dict[int, float]] = defaultdict(lambda: defaultdict(float))
+    for document_id, chunk_id, term, term_frequency, term_count in postings:
+        df = document_frequency.get(term, 0)
+        idf = math.log(1 + (total_chunks - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * (term_count or 0) / average_length)
+        scores[document_id][chunk_id] += idf * term_frequency * (BM25_K1 + 1) / (term_frequency + norm)
+
+    selected_ids = [
+        chunk_id
+        for chunk_scores in scores.values()
+        for chunk_id, _ in sorted(chunk_scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    ]
+    if not selected_ids:
+        return {}
+
+    chunks = (await db.execute(
+        select(DocumentChunk.document_id, DocumentChunk.content)
+        .where(DocumentChunk.id.in_(selected_ids))
+        .order_by(DocumentChunk.document_id, DocumentChunk.chunk_index)
+    )).all()
+
+    results: Dict[int, List[str]] = defaultdict(list)
+    for document_id, content in chunks:
+        results[document_id].append(content)
+    return dict(results)
+
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+
+from .limiter import AdaptiveLimiter, analysis_limiter
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_USER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_USER_MAX_IN_FLIGHT", "8"))
+# Calls from analyses of at most this many documents get SMALL_JOB_WEIGHT times the share
+SCHEDULER_SMALL_JOB_DOCUMENTS = int(os.getenv("SCHEDULER_SMALL_JOB_DOCUMENTS", "5"))
+SCHEDULER_SMALL_JOB_WEIGHT = float(os.getenv("SCHEDULER_SMALL_JOB_WEIGHT", "4"))
+
+# Set by the turn (or job) that makes the calls, inherited by the tasks it starts
+current_user_id: ContextVar[Optional[int]] = ContextVar("current_user_id", default=None)
+current_job_size: ContextVar[int] = ContextVar("current_job_size", default=1)
+
+
+class Waiter:
+    def __init__(self, user_id: Optional[int], tokens: int, finish: float):
+        self.user_id = user_id
+        self.tokens = tokens
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.admitted = asyncio.get_running_loop().create_future()
+
+
+class UserQueue:
+    def __init__(self):
+        self.waiters: Deque[Waiter] = deque()
+        self.in_flight = 0
+        self.last_finish = 0.0
+
+
+class FairScheduler:
+    """Decides whose sub-agent call goes to the shared limiter next.
+
+    Calls are ordered by weighted fair queuing: each gets a virtual finish
+    time of `max(virtual_time, user's last finish) + tokens / weight`, and the
+    earliest finish among users under their in-flight cap is admitted first.
+    A user with hundreds of queued calls therefore cannot delay another
+    user's next call by more than about one call, and calls belonging to
+    small analyses carry a higher weight. Only the dispatcher waits on the
+    limiter, so the limiter admits calls in exactly this order.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, user_max_in_flight: int, small_job_documents: int, small_job_weight: float):
+        self.limiter = limiter
+        self.user_max_in_flight = user_max_in_flight
+        self.small_job_documents = small_job_documents
+        self.small_job_weight = small_job_weight
+        self.virtual_time = 0.0
+        self._users: Dict[Optional[int], UserQueue] = {}
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        metrics.gauge("scheduler.queued", lambda: sum(len(user.waiters) for user in self._users.values()))
+        metrics.gauge("scheduler.active_users", lambda: len(self._users))
+
+    @asynccontextmanager
+    async def acquire(self, estimated_tokens: int):
+        user_id = current_user_id.get()
+        await self._wait_turn(user_id, estimated_tokens, current_job_size.get())
+        try:
+            async with self.limiter.running() as timer:
+                yield timer
+        finally:
+            self._done(user_id)
+
+    async def _wait_turn(self, user_id: Optional[int], tokens: int, job_size: int):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+
+        user = self._users.setdefault(user_id, UserQueue())
+        weight = self.small_job_weight if job_size <= self.small_job_documents else 1.0
+        start = max(self.virtual_time, user.last_finish)
+        user.last_finish = start + max(tokens, 1) / weight
+        waiter = Waiter(user_id, tokens, user.last_finish)
+        user.waiters.append(waiter)
+        self._changed.set()
+
+        try:
+            await asyncio.shield(waiter.admitted)
+        except asyncio.CancelledError:
+            if waiter.admitted.done():
+                # Admitted just as the caller went away, give the slot back
+                self.limiter.release()
+                self._done(user_id)
+            else:
+                waiter.admitted.cancel()
+            raise
+
+        waited = time.monotonic() - waiter.enqueued
+        metrics.observe("scheduler.wait", waited)
+        metrics.observe(f"scheduler.wait.user.{user_id}", waited)
+
+    def _done(self, user_id: Optional[int]):
+        user = self._users.get(user_id)
+        if user is not None:
+            user.in_flight -= 1
+            self._forget_if_idle(user_id)
+        self._changed.set()
+
+    def _forget_if_idle(self, user_id: Optional[int]):
+        user = self._users.get(user_id)
+        # An idle user's next call starts from the current virtual time anyway
+        if user and not user.waiters and user.in_flight <= 0:
+            del self._users[user_id]
+
+    def _next_waiter(self) -> Optional[Waiter]:
+        best = None
+        for user_id, user in list(self._users.items()):
+            while user.waiters and user.waiters[0].admitted.cancelled():
+                user.waiters.popleft()
+            if not user.waiters:
+                self._forget_if_idle(user_id)
+                continue
+            if user.in_flight >= self.user_max_in_flight:
+                continue
+            if best is None or user.waiters[0].finish < best.finish:
+                best = user.waiters[0]
+        return best
+
+    async def _dispatch(self):
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+
+            user = self._users[waiter.user_id]
+            user.waiters.popleft()
+            # Reserve the user's slot first so the cap holds while we wait on the limiter
+            user.in_flight += 1
+            metrics.observe("analysis_limiter.wait", await self.limiter.admit(waiter.tokens))
+            if waiter.admitted.cancelled():
+                self.limiter.release()
+                self._done(waiter.user_id)
+                continue
+
+            # Self-clocked: virtual time is the finish time of the call last admitted
+            self.virtual_time = max(self.virtual_time, waiter.finish)
+            waiter.admitted.set_result(None)
+
+
+fair_scheduler = FairScheduler(
+    analysis_limiter,
+    SCHEDULER_USER_MAX_IN_FLIGHT,
+    SCHEDULER_SMALL_JOB_DOCUMENTS,
+    SCHEDULER_SMALL_JOB_WEIGHT,
+)
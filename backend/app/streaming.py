@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "50"))
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "1024"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What happens to a client that falls behind: drop_deltas, coalesce or disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+SLOW_CONSUMER_POLICIES = ("drop_deltas", "coalesce", "disconnect")
+
+
+def assistant_message_frame(text: str, seq: Optional[int] = None) -> str:
+    frame = {
+        "type": "assistant_message",
+        "content": text
+    }
+    if seq is not None:
+        frame["seq"] = seq
+    return json.dumps(frame)
+
+
+def with_seq(message: str, seq: int) -> str:
+    # Frames are JSON objects, splice the field in rather than re-encoding them
+    return f'{{"seq": {seq}, ' + message[1:]
+
+
+class DeltaCoalescer:
+    """Merges assistant text deltas into fewer, larger deltas.
+
+    Buffered text is handed to `send` once `max_bytes` are waiting or
+    `interval_ms` has passed since the first buffered delta. Callers must
+    `flush()` before sending any other frame so ordering is preserved.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        interval_ms: float = STREAM_COALESCE_MS,
+        max_bytes: int = STREAM_COALESCE_BYTES,
+    ):
+        self._send = send
+        self.interval = interval_ms / 1000
+        self.max_bytes = max_bytes
+        self._parts: List[str] = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, text: str):
+        metrics.inc("stream.deltas")
+        self._parts.append(text)
+        self._size += len(text.encode())
+
+        if self._size >= self.max_bytes or self.interval <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._on_timer)
+
+    async def flush(self):
+        self._cancel_timer()
+        async with self._lock:
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts = []
+            self._size = 0
+            metrics.inc("stream.frames")
+            await self._send(text)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_task = asyncio.create_task(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class ConnectionSender:
+    """Bounded outbound queue for one websocket, drained by its own writer task.
+
+    `send` never blocks the producer. When a client falls behind, `policy`
+    decides what happens: `coalesce` merges assistant text deltas into the
+    newest queued delta, `drop_deltas` discards deltas once the queue is full,
+    and `disconnect` closes the socket once the queue is full. Other frames are
+    never dropped; if one cannot be queued, or a single send stalls for longer
+    than `send_timeout`, the connection is closed.
+
+    A sender created `paused` queues frames without writing them until
+    `resume` is called with the frames a reconnecting client missed.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int, policy: str, send_timeout: float, on_close: Callable[[], None], paused: bool = False):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.closed = False
+        self._on_close = on_close
+        # Entries are [payload, is_delta, seq]; delta payloads are raw text until written
+        self._queue: Deque[List] = deque()
+        self._ready = asyncio.Event()
+        self._resumed = asyncio.Event()
+        if not paused:
+            self._resumed.set()
+        self._task = asyncio.create_task(self._run())
+        self._close_task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send(self, payload: str, delta: bool = False, seq: Optional[int] = None):
+        if self.closed:
+            return
+
+        if delta and self.policy == "coalesce" and self._queue and self._queue[-1][1]:
+            # The merged frame carries the newest seq it covers
+            self._queue[-1][0] += payload
+            self._queue[-1][2] = seq
+            metrics.inc("ws_send.coalesced")
+            return
+
+        if len(self._queue) >= self.max_queue:
+            if self.policy != "drop_deltas":
+                self._disconnect("send queue full")
+                return
+            if delta:
+                metrics.inc("ws_send.dropped_deltas")
+                return
+            if not self._drop_oldest_delta():
+                self._disconnect("send queue full of undroppable frames")
+                return
+
+        self._queue.append([payload, delta, seq])
+        self._ready.set()
+
+    def resume(self, replayed: List[Tuple[str, Optional[int]]]):
+        """Write `replayed` frames first, then whatever was queued while paused."""
+        replayed_seqs = [seq for _, seq in replayed if seq is not None]
+        if replayed_seqs:
+            # Live frames that were also replayed must not be sent twice
+            last_seq = replayed_seqs[-1]
+            self._queue = deque(entry for entry in self._queue if entry[2] is None or entry[2] > last_seq)
+        self._queue.extendleft([payload, False, seq] for payload, seq in reversed(replayed))
+        self._ready.set()
+        self._resumed.set()
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def _drop_oldest_delta(self) -> bool:
+        for index, entry in enumerate(self._queue):
+            if entry[1]:
+                del self._queue[index]
+                metrics.inc("ws_send.dropped_deltas")
+                return True
+        return False
+
+    def _disconnect(self, reason: str):
+        metrics.inc("ws_send.slow_disconnects")
+        logger.warning(f"Disconnecting slow websocket client: {reason}")
+        self.close()
+        self._on_close()
+        self._close_task = asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            # 1013: try again later
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _run(self):
+        await self._resumed.wait()
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+
+            payload, delta, seq = self._queue.popleft()
+            if delta:
+                payload = assistant_message_frame(payload, seq)
+            try:
+                await asyncio.wait_for(self.websocket.send_text(payload), self.send_timeout)
+            except asyncio.TimeoutError:
+                self._disconnect(f"send stalled for over {self.send_timeout}s")
+                return
+            except Exception as e:
+                # The socket is gone, the endpoint's receive loop will clean up
+                logger.info(f"Websocket writer stopped: {str(e)}")
+                self.close()
+                return
+            metrics.inc("ws_send.frames")
@@ -0,0 +1,60 @@
+from typing import Dict, List, Tuple
+
+from sqlalchemy import and_, delete, exists, insert, or_, true
+
+from .models import Document, DocumentTag
+
+
+def tag_pairs(tags) -> List[Tuple[str, str]]:
+    # Tags are stored as a list of {"key": ..., "value": ...} objects on the document
+    pairs = []
+    for tag in tags or []:
+        if isinstance(tag, dict) and tag.get("key") and tag.get("value") is not None:
+            pair = (str(tag["key"]), str(tag["value"]))
+            if pair not in pairs:
+                pairs.append(pair)
+    return pairs
+
+
+def parse_tag_filters(tags: List[str]) -> List[Tuple[str, str]]:
+    """Parses `key:value` query parameters, each of which may hold several comma separated tags."""
+    pairs = []
+    for param in tags:
+        for tag in filter(None, param.split(",")):
+            key, separator, value = tag.partition(":")
+            if not separator:
+                raise ValueError(f"Invalid tag filter '{tag}', expected key:value")
+            pairs.append((key, value))
+    return pairs
+
+
+def tag_filter(pairs: List[Tuple[str, str]], match_all: bool = True):
+    """A WHERE clause on Document matching documents with all (or any) of the tags, served by the document_tags index."""
+    if not pairs:
+        return true()
+    if match_all:
+        return and_(*[
+            exists().where(DocumentTag.document_id == Document.id, DocumentTag.key == key, DocumentTag.value == value)
+            for key, value in pairs
+        ])
+    return exists().where(
+        DocumentTag.document_id == Document.id,
+        or_(*[and_(DocumentTag.key == key, DocumentTag.value == value) for key, value in pairs]),
+    )
+
+
+def tag_rows(documents: List[Document]) -> List[Dict]:
+    return [
+        {"document_id": document.id, "key": key, "value": value}
+        for document in documents
+        for key, value in tag_pairs(document.tags)
+    ]
+
+
+def replace_tags_statements(documents: List[Document]) -> list:
+    """Statements that rewrite document_tags for documents whose `tags` were set, run by sync or async sessions alike."""
+    statements = [delete(DocumentTag).where(DocumentTag.document_id.in_([document.id for document in documents]))]
+    rows = tag_rows(documents)
+    if rows:
+        statements.append(insert(DocumentTag).values(rows))
+    return statements
@@ -26,3 +26,7 @@ def get_aws_secret(secret_name):
             return get_secret_value_response['SecretString']
     except ClientError as e:
         raise e
+
+def estimate_tokens(text: str) -> int:
+    # Rough heuristic of ~4 characters per token, good enough for budgeting
+    return len(text) // 4 + 1
@@ -0,0 +1,50 @@
+"""Fills in text_hash for documents stored before upload deduplication.
+
+content_hash is the hash of the uploaded bytes, which were never kept, so it
+stays empty for these rows and they are matched on their text alone.
+
+Usage: python scripts/backfill_document_hashes.py [--batch-size 500]
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import select, update
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import SessionLocal
+from app.ingest import text_hash
+from app.models import Document
+
+
+def backfill(batch_size: int):
+    db = SessionLocal()
+    try:
+        last_id, updated = 0, 0
+        while True:
+            rows = db.execute(
+                select(Document.id, Document.content)
+                .where(Document.text_hash.is_(None), Document.id > last_id)
+                .order_by(Document.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            db.execute(update(Document), [{"id": id, "text_hash": text_hash(content or "")} for id, content in rows])
+            db.commit()
+            last_id = rows[-1].id
+            updated += len(rows)
+            print(f"Hashed {updated} documents")
+    finally:
+        db.close()
+
+    print(f"Done, {updated} documents hashed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=500)
+    backfill(parser.parse_args().batch_size)
@@ -0,0 +1,98 @@
+"""Compares upload throughput of the single-file and bulk document endpoints.
+
+Uploads are deduplicated, so run each mode against a database that has not
+seen the files yet, otherwise the second run only measures duplicate checks.
+
+Usage: python scripts/benchmark_upload.py DIRECTORY --mode single|bulk --username USER --password PASS [--concurrency 4]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import List
+
+import httpx
+
+API_URL = os.getenv("API_URL", "http://localhost:8000/api")
+TAGS = [{"key": "source", "value": "benchmark"}]
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str) -> str:
+    response = await client.post(f"{API_URL}/users/token", data={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def upload_single(client: httpx.AsyncClient, paths: List[str], concurrency: int) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def upload(path: str):
+        nonlocal failures
+        async with semaphore:
+            with open(path, "rb") as f:
+                response = await client.post(
+                    f"{API_URL}/documents/upload",
+                    files={"file": (os.path.basename(path), f)},
+                    data={"tags": json.dumps(TAGS)},
+                )
+            if response.status_code != 200:
+                failures += 1
+
+    await asyncio.gather(*[upload(path) for path in paths])
+    return failures
+
+
+async def upload_bulk(client: httpx.AsyncClient, paths: List[str]) -> int:
+    handles = [open(path, "rb") for path in paths]
+    try:
+        files = [("files", (os.path.basename(path), handle)) for path, handle in zip(paths, handles)]
+        async with client.stream("POST", f"{API_URL}/documents/upload/bulk", files=files, data={"tags": json.dumps(TAGS)}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    event = json.loads(line)
+                    if event["status"] == "complete":
+                        return event["errors"]
+    finally:
+        for handle in handles:
+            handle.close()
+    raise RuntimeError("Bulk upload ended without a summary")
+
+
+def report(name: str, paths: List[str], seconds: float, failures: int):
+    megabytes = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+    print(f"{name:>6}: {len(paths)} files, {megabytes:.1f} MB in {seconds:.2f}s "
+          f"({len(paths) / seconds:.1f} files/s, {megabytes / seconds:.2f} MB/s), {failures} failed")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory")
+    parser.add_argument("--mode", choices=["single", "bulk"], required=True)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel requests for the single-file endpoint")
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.directory, name) for name in os.listdir(args.directory)
+        if os.path.isfile(os.path.join(args.directory, name))
+    )
+    if not paths:
+        raise SystemExit(f"No files found in {args.directory}")
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        client.headers["Authorization"] = f"Bearer {await login(client, args.username, args.password)}"
+
+        started = time.perf_counter()
+        if args.mode == "single":
+            failures = await upload_single(client, paths, args.concurrency)
+        else:
+            failures = await upload_bulk(client, paths)
+        report(args.mode, paths, time.perf_counter() - started, failures)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""Rebuilds the BM25 chunks and postings of every document, and the corpus stats with them.
+
+Run it after changing CHUNK_TOKENS or the tokenizer, or to index documents
+stored before retrieval existed.
+
+Usage: python scripts/reindex_documents.py [--batch-size 100]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from sqlalchemy import select
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import AsyncSessionLocal
+from app.models import Document
+from app.pdf_extraction import shutdown_executor
+from app.retrieval import index_document, update_corpus_stats
+
+
+async def reindex(batch_size: int):
+    async with AsyncSessionLocal() as db:
+        last_id, reindexed = 0, 0
+        while True:
+            documents = (await db.execute(
+                select(Document).where(Document.id > last_id).order_by(Document.id).limit(batch_size)
+            )).scalars().all()
+            if not documents:
+                break
+
+            stats_changes = [await index_document(db, document) for document in documents]
+            await db.commit()
+            await update_corpus_stats(db, sum(chunks for chunks, _ in stats_changes), sum(terms for _, terms in stats_changes))
+            last_id = documents[-1].id
+            reindexed += len(documents)
+            # Only one batch of documents is held in memory at a time
+            db.expunge_all()
+            print(f"Reindexed {reindexed} documents")
+
+    print(f"Done, {reindexed} documents reindexed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100)
+    try:
+        asyncio.run(reindex(parser.parse_args().batch_size))
+    finally:
+        shutdown_executor()
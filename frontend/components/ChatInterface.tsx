@@ -5,7 +5,7 @@ import useWebSocket, { ReadyState } from 'react-use-websocket';
 import { Button } from "@/components/ui/button";
 import { Textarea } from "@/components/ui/textarea";
 import { ScrollArea } from "@/components/ui/scroll-area";
-import { SendIcon, Bot, Loader2, LightbulbIcon } from "lucide-react";
+import { SendIcon, Bot, Loader2, LightbulbIcon, Square } from "lucide-react";
 import Markdown from 'markdown-to-jsx';
 import DocumentAnalysisGrid from './DocumentAnalysisGrid';
 import { getWebSocketUrl, createConversation, Conversation} from '@/lib/api';
@@ -44,6 +44,7 @@ enum DocumentAnalysisStatus {
   PENDING = "pending",
   IN_PROGRESS = "in_progress",
   COMPLETE = "complete",
+  PARTIAL = "partial",
   ERROR = "error"
 }
 
@@ -71,9 +72,17 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
   const [citationKey, setCitationKey] = useState(0);
   const [documentStatuses, setDocumentStatuses] = useState<DocumentStatus[]>([]);
   const [documentAnalysisResults, setDocumentAnalysisResults] = useState<DocumentAnalysisMessage[]>([]);
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
+  const [isLoadingHistory, setIsLoadingHistory] = useState(false);
+
+  const lastSeqRef = useRef<number | null>(null);
+  const getSocketUrl = useCallback(
+    async () => getWebSocketUrl(conversationId, lastSeqRef.current) as string,
+    [conversationId]
+  );
 
   const { sendMessage, lastMessage, readyState } = useWebSocket(
-    getWebSocketUrl(conversationId),
+    getWebSocketUrl(conversationId) ? getSocketUrl : null,
     {
       shouldReconnect: (closeEvent) => true,
       reconnectAttempts: 10,
@@ -109,6 +118,8 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
       // Reset messages and current assistant message
       setMessages([]);
       setCurrentAssistantMessage('');
+      setHistoryCursor(null);
+      lastSeqRef.current = null;
       
       // Reset citations
       setCitations({});
@@ -122,6 +133,9 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
     if (lastMessage !== null) {
       try {
         const parsedMessage = JSON.parse(lastMessage.data);
+        if (typeof parsedMessage.seq === 'number') {
+          lastSeqRef.current = parsedMessage.seq;
+        }
         handleParsedMessage(parsedMessage);
       } catch (error) {
         console.error("Error parsing WebSocket message:", error);
@@ -129,41 +143,53 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
     }
   }, [lastMessage]);
 
+  const processHistoryMessage = (msg: any): Message => {
+    if (msg.role === "document_analysis") {
+      const content = typeof msg.content === 'string' ? JSON.parse(msg.content) : msg.content;
+      return {
+        role: msg.role,
+        content: {
+          status: content.status,
+          total_documents: content.total_documents || 0,
+          completed_documents: content.completed_documents || 0,
+          document_data: content.documents?.map((doc: any) => ({
+            id: doc.document_id,
+            document_date: doc.document_date,
+            status: doc.status as DocumentAnalysisStatus,
+            document_id: doc.document_id,
+            document_filename: doc.document_filename
+          })) || []
+        }
+      };
+    }
+    return {
+      role: msg.role,
+      content: msg.content[0].text
+    };
+  };
+
+  const handleLoadEarlier = () => {
+    if (!historyCursor || isLoadingHistory) return;
+    setIsLoadingHistory(true);
+    sendMessage(JSON.stringify({ type: 'load_history', cursor: historyCursor }));
+  };
+
   const handleParsedMessage = (parsedMessage: any) => {
     switch (parsedMessage.type) {
       case "conversation_history":
-        const processedMessages = parsedMessage.content.map((msg: any) => {
-          if (msg.role === "document_analysis") {
-            const content = typeof msg.content === 'string' ? JSON.parse(msg.content) : msg.content;
-            return {
-              role: msg.role,
-              content: {
-                status: content.status,
-                total_documents: content.total_documents || 0,
-                completed_documents: content.completed_documents || 0,
-                document_data: content.documents?.map((doc: any) => ({
-                  id: doc.document_id,
-                  document_date: doc.document_date,
-                  status: doc.status as DocumentAnalysisStatus,
-                  document_id: doc.document_id,
-                  document_filename: doc.document_filename
-                })) || []
-              }
-            };
-          }
-          return {
-            role: msg.role,
-            content: msg.role === "document_analysis" ? JSON.stringify(msg.content) : msg.content[0].text
-          };
-        });
+      case "conversation_history_page":
+        const isFirstPage = parsedMessage.type === "conversation_history";
+        const processedMessages = parsedMessage.content.map(processHistoryMessage);
+        setHistoryCursor(parsedMessage.has_more ? parsedMessage.cursor : null);
+        setIsLoadingHistory(false);
 
-        setMessages(processedMessages);
+        setMessages(prev => isFirstPage ? processedMessages : [...processedMessages, ...prev]);
         
         const documentAnalysisMessages = processedMessages
           .filter((msg: Message) => msg.role === "document_analysis")
           .map((msg: Message) => msg.content as DocumentAnalysisMessage);
         
-        setDocumentAnalysisResults(documentAnalysisMessages);
+        setDocumentAnalysisResults(prev => isFirstPage ? documentAnalysisMessages : [...documentAnalysisMessages, ...prev]);
         
         // Process citations from conversation history
         const historyCitations = parsedMessage.content.reduce((acc: Record<string, CitationData>, msg: any) => {
@@ -174,7 +200,7 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
           }
           return acc;
         }, {});
-        setCitations(historyCitations);
+        setCitations(prev => isFirstPage ? historyCitations : { ...historyCitations, ...prev });
         break;
       case "assistant_message":
         setCurrentAssistantMessage(prev => prev + parsedMessage.content);
@@ -214,6 +240,12 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
         }, {});
         setCitations(newCitations);
         break;
+      case "partial_citations":
+        setCitations(prev => parsedMessage.citations.reduce((acc: Record<string, CitationData>, quote: CitationData) => {
+          acc[quote.id] = quote;
+          return acc;
+        }, { ...prev }));
+        break;
       default:
         console.warn("Unknown message type:", parsedMessage.type);
     }
@@ -255,7 +287,7 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
           content: {
             status: "in_progress",
             total_documents: analysisMessage.total_documents || documentStatuses.length,
-            completed_documents: documentStatuses.filter(doc => doc.status === DocumentAnalysisStatus.COMPLETE).length,
+            completed_documents: documentStatuses.filter(doc => doc.status === DocumentAnalysisStatus.COMPLETE || doc.status === DocumentAnalysisStatus.PARTIAL).length,
             document_data: documentStatuses
           }
         }];
@@ -266,7 +298,7 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
         ? { status: 'in_progress' } 
         : { ...updatedMessage.content };
 
-      content.completed_documents = documentStatuses.filter(doc => doc.status === DocumentAnalysisStatus.COMPLETE).length;
+      content.completed_documents = documentStatuses.filter(doc => doc.status === DocumentAnalysisStatus.COMPLETE || doc.status === DocumentAnalysisStatus.PARTIAL).length;
       content.document_data = documentStatuses;
 
       return [...prev.slice(0, lastIndex), { ...updatedMessage, content }];
@@ -305,6 +337,12 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
     }
   };
 
+  const handleStopStreaming = () => {
+    if (readyState === ReadyState.OPEN) {
+      sendMessage(JSON.stringify({ type: 'stop' }));
+    }
+  };
+
   const connectionStatus = {
     [ReadyState.CONNECTING]: 'Connecting',
     [ReadyState.OPEN]: 'Open',
@@ -342,7 +380,7 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
 
   const getButtonContent = () => {
     if (isStreaming) {
-      return <Loader2 className="h-5 w-5 animate-spin" />;
+      return <Square className="h-5 w-5" />;
     }
     if (readyState === ReadyState.OPEN) {
       return <SendIcon className="h-5 w-5" />;
@@ -397,6 +435,13 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
       <div className="flex h-full bg-gradient-to-b from-gray-50 to-white rounded-xl shadow-lg w-full overflow-hidden">
         <div className="flex flex-col flex-grow relative">
           <ScrollArea className="flex-grow mb-4 px-4 py-6">
+            {historyCursor && (
+              <div className="flex justify-center mb-4">
+                <Button variant="ghost" size="sm" onClick={handleLoadEarlier} disabled={isLoadingHistory}>
+                  {isLoadingHistory ? <Loader2 className="h-4 w-4 animate-spin" /> : "Load earlier messages"}
+                </Button>
+              </div>
+            )}
             {messages.map((msg, index) => (
               <div key={index} className="mb-4">
                 {msg.role === "user" ? (
@@ -489,8 +534,8 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
                 <Tooltip>
                   <TooltipTrigger asChild>
                     <Button 
-                      onClick={handleSendMessage} 
-                      disabled={isInputDisabled}
+                      onClick={isStreaming ? handleStopStreaming : handleSendMessage} 
+                      disabled={isStreaming ? readyState !== ReadyState.OPEN : isInputDisabled}
                       className={cn(
                         "ml-2 p-2 rounded-full transition-colors duration-200",
                         readyState === ReadyState.OPEN 
@@ -499,7 +544,7 @@ export default function ChatInterface({ selectedData, conversationId, onNewMessa
                       )}
                     >
                       {getButtonContent()}
-                      <span className="sr-only">Send</span>
+                      <span className="sr-only">{isStreaming ? 'Stop' : 'Send'}</span>
                     </Button>
                   </TooltipTrigger>
                   <TooltipContent>
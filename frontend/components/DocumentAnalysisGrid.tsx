@@ -11,6 +11,7 @@ export enum DocumentAnalysisStatus {
   PENDING = "pending",
   IN_PROGRESS = "in_progress",
   COMPLETE = "complete", 
+  PARTIAL = "partial",
   ERROR = "error"
 }
 
@@ -74,6 +75,8 @@ const DocumentAnalysisGrid: React.FC<DocumentAnalysisGridProps> = ({
     switch (status) {
       case DocumentAnalysisStatus.COMPLETE:
         return 'bg-green-500 hover:bg-green-600';
+      case DocumentAnalysisStatus.PARTIAL:
+        return 'bg-orange-500 hover:bg-orange-600';
       case DocumentAnalysisStatus.IN_PROGRESS:
         return 'bg-yellow-500 hover:bg-yellow-600';
       case DocumentAnalysisStatus.ERROR:
@@ -88,6 +91,8 @@ const DocumentAnalysisGrid: React.FC<DocumentAnalysisGridProps> = ({
     switch (status) {
       case DocumentAnalysisStatus.COMPLETE:
         return <IoCheckmarkCircle className="text-white w-3 h-3" />;
+      case DocumentAnalysisStatus.PARTIAL:
+        return <FaExclamationTriangle className="text-white w-3 h-3" />;
       case DocumentAnalysisStatus.IN_PROGRESS:
         return <IoTimeOutline className="text-white w-3 h-3 animate-spin" />;
       case DocumentAnalysisStatus.ERROR:
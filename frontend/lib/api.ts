@@ -62,13 +62,15 @@ export const getConversation = async (id: string): Promise<Conversation> => {
   return response.data;
 };
 
-export const getWebSocketUrl = (conversationId: string | null): string | null => {
+export const getWebSocketUrl = (conversationId: string | null, lastSeq: number | null = null): string | null => {
   const token = localStorage.getItem('access_token');
   if (!token) return null;
 
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
   const host = process.env.NODE_ENV === 'development' ? 'localhost:8000' : 'accountingbot.io';
-  return `${protocol}//${host}/api/chat/ws/${conversationId || 'null'}?token=${token}`;
+  // Reconnects pass the last frame seen so the server replays only what was missed
+  const resume = lastSeq !== null ? `&last_seq=${lastSeq}` : '';
+  return `${protocol}//${host}/api/chat/ws/${conversationId || 'null'}?token=${token}${resume}`;
 };
 
 export const fetchDocuments = async (tags?: Array<{key: string, value: string}>): Promise<Document[]> => {